@@ -16,7 +16,6 @@ as a one-shot check.
 """
 
 import sys, os, argparse, time
-import simplejson as json
 import helpers
 
 
@@ -31,58 +30,53 @@ def check_running_tasks(clear):
         os.system('clear')
 
     print helpers.HEADER + "Checking for running/paused yum sync tasks..." + helpers.ENDC
-    tasks = helpers.get_p_json(
-        helpers.FOREMAN_API + "tasks/",
-        json.dumps(
-            {
-                "per_page": "100",
-            }
-            )
-        )
-
-    # From the list of tasks, look for any running export or sync jobs.
-    # If e have any we exit, as we can't export in this state.
+    snapshot = helpers.get_task_snapshot(refresh=True)
+
+    # From the list of active tasks, look for any running or paused sync jobs.
     running_sync = 0
-    for task_result in tasks['results']:
-        if task_result['state'] == 'running' and task_result['label'] != 'Actions::BulkAction':
-            if task_result['humanized']['action'] == 'Synchronize':
-                running_sync = 1
-                print helpers.BOLD + "Running: " + helpers.ENDC \
-                    + task_result['input']['repository']['name']
-        if task_result['state'] == 'paused' and task_result['label'] != 'Actions::BulkAction':
-            if task_result['humanized']['action'] == 'Synchronize':
-                running_sync = 1
-                print helpers.ERROR + "Paused:  " + helpers.ENDC \
-                    + task_result['input']['repository']['name']
+    for task_result in snapshot['action'].get(('running', 'Synchronize'), []):
+        running_sync = 1
+        print helpers.BOLD + "Running: " + helpers.ENDC \
+            + task_result['input']['repository']['name']
+    for task_result in snapshot['action'].get(('paused', 'Synchronize'), []):
+        running_sync = 1
+        print helpers.ERROR + "Paused:  " + helpers.ENDC \
+            + task_result['input']['repository']['name']
 
     if not running_sync:
         print helpers.GREEN + "None detected" + helpers.ENDC
 
     # Check any repos marked as Sync Incomplete
     print helpers.HEADER + "\nChecking for incomplete (stopped) yum sync tasks..." + helpers.ENDC
-    repo_list = helpers.get_json(
+    repo_list = helpers.get_paged(
         helpers.KATELLO_API + "/content_view_versions")
 
-    # Extract the list of repo ids, then check the state of each one.
-    incomplete_sync = 0
-    for repo in repo_list['results']:
+    # Extract the de-duplicated list of repo ids, then check the state of each one.
+    repo_ids = set()
+    version_ids = set()
+    for repo in repo_list:
+        version_ids.add(repo['id'])
         for repo_id in repo['repositories']:
-            repo_status = helpers.get_json(
-                helpers.KATELLO_API + "/repositories/" + str(repo_id['id']))
-
-            if repo_status['content_type'] == 'yum':
-                if repo_status['last_sync'] is None:
-                    if repo_status['library_instance_id'] is None:
-#                        incomplete_sync = 1
-#                        print helpers.ERROR + "Broken Repo: " + helpers.ENDC + repo_status['name']
-                        print helpers.WARNING + "Never Synchronized: " + helpers.ENDC + repo_status['name']
-                elif repo_status['last_sync']['state'] == 'stopped':
-                    if repo_status['last_sync']['result'] == 'warning':
-                        incomplete_sync = 1
-                        print helpers.WARNING + "Incomplete: " + helpers.ENDC + repo_status['name']
-                    else:
-                        msg = repo_status['name'] + " - last_sync: " + repo_status['last_sync']['ended_at']
-                        helpers.log_msg(msg, 'DEBUG')
+            repo_ids.add(repo_id['id'])
+    repos = helpers.get_repositories(repo_ids, version_ids)
+
+    incomplete_sync = 0
+    for repo_id in sorted(repo_ids):
+        repo_status = repos[repo_id]
+
+        if repo_status['content_type'] == 'yum':
+            if repo_status['last_sync'] is None:
+                if repo_status['library_instance_id'] is None:
+#                    incomplete_sync = 1
+#                    print helpers.ERROR + "Broken Repo: " + helpers.ENDC + repo_status['name']
+                    print helpers.WARNING + "Never Synchronized: " + helpers.ENDC + repo_status['name']
+            elif repo_status['last_sync']['state'] == 'stopped':
+                if repo_status['last_sync']['result'] == 'warning':
+                    incomplete_sync = 1
+                    print helpers.WARNING + "Incomplete: " + helpers.ENDC + repo_status['name']
+                else:
+                    msg = repo_status['name'] + " - last_sync: " + repo_status['last_sync']['ended_at']
+                    helpers.log_msg(msg, 'DEBUG')
 
     # If we have detected incomplete sync tasks, ask the user if they want to export anyway.
     # This isn't fatal, but *MAY* lead to inconsistent repositories on the disconnected sat.
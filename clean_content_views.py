@@ -20,14 +20,13 @@ def get_cv(org_id, cleanup_list, keep):
     """Get the content views."""
 
     # Query API to get all content views for our org
-    cvs = helpers.get_json(
-        helpers.KATELLO_API + "organizations/" + str(org_id) + "/content_views/")
+    cvs = helpers.get_content_views(org_id)
     ver_list = collections.OrderedDict()
     ver_descr = collections.OrderedDict()
     ver_keep = collections.OrderedDict()
 
     # Sort the CVS so that composites are considered first
-    cv_results = sorted(cvs['results'], key=lambda k: k[u'composite'], reverse=True)
+    cv_results = sorted(cvs, key=lambda k: k[u'composite'], reverse=True)
 
     for cv_result in cv_results:
         # We will never clean the DOV
@@ -244,6 +243,9 @@ def cleanup(ver_list, ver_descr, dry_run, runuser, ver_keep, cleanall, ignorefir
                     # Wait for the task to complete
                     helpers.wait_for_task(task_id,'clean')
 
+                    # The cached content views no longer show the removed version
+                    helpers.invalidate_cache('content_views')
+
                     # Check if the deletion completed successfully
                     tinfo = helpers.get_task_status(task_id)
                     if tinfo['state'] != 'running' and tinfo['result'] == 'success':
@@ -9,18 +9,30 @@
 
 """Functions common to various Satellite 6 scripts."""
 
-import sys, os, time, datetime, argparse
-import logging, tempfile
+import sys, os, time, datetime, argparse, glob, pickle, sqlite3
+import logging, tempfile, threading, Queue
 from time import sleep
 from hashlib import sha256
 import smtplib
 
 try:
     import requests
+    from requests.adapters import HTTPAdapter
 except ImportError:
     print "Please install the python-requests module."
     sys.exit(1)
 
+try:
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError:
+    Retry = None
+
+try:
+    import simplejson as json
+except ImportError:
+    print "Please install the python-simplejson module."
+    sys.exit(1)
+
 try:
     import yaml
 except ImportError:
@@ -56,6 +68,10 @@ if 'syncbatch' in CONFIG['import']:
     SYNCBATCH = CONFIG['import']['syncbatch']
 else:
     SYNCBATCH = 255
+if 'syncinflight' in CONFIG['import']:
+    SYNCINFLIGHT = CONFIG['import']['syncinflight']
+else:
+    SYNCINFLIGHT = 1
 if 'batch' in CONFIG['publish']:
     PUBLISHBATCH = CONFIG['publish']['batch']
 else:
@@ -86,6 +102,34 @@ else:
     PFUSER = runuser
 if 'token' in CONFIG['puppet-forge-server']:
     PFTOKEN = CONFIG['puppet-forge-server']['token']
+if 'poolsize' in CONFIG['satellite']:
+    POOLSIZE = CONFIG['satellite']['poolsize']
+else:
+    POOLSIZE = 10
+if 'timeout' in CONFIG['satellite']:
+    TIMEOUT = CONFIG['satellite']['timeout']
+else:
+    TIMEOUT = 300
+if 'retries' in CONFIG['satellite']:
+    RETRIES = CONFIG['satellite']['retries']
+else:
+    RETRIES = 3
+if 'pollmin' in CONFIG['satellite']:
+    POLL_MIN = CONFIG['satellite']['pollmin']
+else:
+    POLL_MIN = 2
+if 'pollmax' in CONFIG['satellite']:
+    POLL_MAX = CONFIG['satellite']['pollmax']
+else:
+    POLL_MAX = 30
+if 'pagesize' in CONFIG['satellite']:
+    PAGESIZE = CONFIG['satellite']['pagesize']
+else:
+    PAGESIZE = 100
+if 'cachettl' in CONFIG['satellite']:
+    CACHE_TTL = CONFIG['satellite']['cachettl']
+else:
+    CACHE_TTL = 600
 
 # 'Global' Satellite 6 parameters
 # Satellite API
@@ -96,6 +140,21 @@ KATELLO_API = "%s/katello/api/" % URL
 FOREMAN_API = "%s/foreman_tasks/api/" % URL
 # HTML Headers for all API POST calls
 POST_HEADERS = {'content-type': 'application/json'}
+# Server-side search filter for tasks that may hold a lock
+ACTIVE_TASK_SEARCH = "state = planning or state = running or state = paused"
+# Task actions that lock a content view, with the descriptions used in lock messages
+CV_LOCK_ACTIONS = {
+    'Publish': ('publish', 'Publish'),
+    'Promotion': ('promotion', 'Promotion'),
+    'Promote': ('promotion', 'Promotion'),
+    'Remove Versions and Associations': ('remove', 'CV deletion'),
+}
+# Number of times the task snapshot is refreshed to see a planning-state task move on
+PLANNING_RETRIES = 3
+# Snapshot of active tasks, taken once per run
+TASK_SNAPSHOT = None
+# Repository details needed from a bulk repository listing
+REPO_DETAIL_KEYS = ['content_type', 'name', 'url', 'last_sync', 'library_instance_id']
 
 # Define our global message colours
 PURPLE = '\033[95m'
@@ -125,49 +184,208 @@ def who_is_running():
     return runuser
 
 
+# Shared HTTP session for all API calls
+SESSION = None
+
+
+def get_session():
+    """Return the shared keep-alive session used for all Satellite API calls.
+
+    The session is created on first use with a connection pool of POOLSIZE and
+    authentication set once. Connection errors and 5xx responses are retried
+    RETRIES times with exponential backoff. POST requests are only retried if
+    the connection could not be made, so tasks are never triggered twice.
+    """
+    global SESSION
+    if SESSION is None:
+        if Retry is not None:
+            try:
+                # Hand the final response back to the caller rather than raising
+                retries = Retry(total=RETRIES, backoff_factor=1,
+                    status_forcelist=[500, 502, 503, 504], raise_on_status=False)
+            except TypeError:
+                retries = Retry(total=RETRIES, backoff_factor=1,
+                    status_forcelist=[500, 502, 503, 504])
+        else:
+            retries = RETRIES
+        adapter = HTTPAdapter(pool_connections=POOLSIZE, pool_maxsize=POOLSIZE,
+            max_retries=retries)
+        SESSION = requests.Session()
+        SESSION.auth = (USERNAME, PASSWORD)
+        SESSION.verify = True
+        SESSION.mount('https://', adapter)
+        SESSION.mount('http://', adapter)
+    return SESSION
+
+
 # Define the GET and POST methods
 def get_json(location):
     """Performs a GET using the passed URL location."""
-    result = requests.get(
+    result = get_session().get(
         location,
-        auth=(USERNAME, PASSWORD),
-        verify=True)
+        timeout=TIMEOUT)
     return result.json()
 
 
 def get_p_json(location, json_data):
     """Performs a GET with input data to the URL location."""
-    result = requests.get(
+    result = get_session().get(
         location,
         data=json_data,
-        auth=(USERNAME, PASSWORD),
-        verify=True,
+        timeout=TIMEOUT,
         headers=POST_HEADERS)
     return result.json()
 
 
 def put_json(location, json_data):
     """Performs a PUT and passes the data to the URL location."""
-    result = requests.put(
+    result = get_session().put(
         location,
         data=json_data,
-        auth=(USERNAME, PASSWORD),
-        verify=True,
+        timeout=TIMEOUT,
         headers=POST_HEADERS)
     return result.json()
 
 
 def post_json(location, json_data):
     """Performs a POST and passes the data to the URL location."""
-    result = requests.post(
+    result = get_session().post(
         location,
         data=json_data,
-        auth=(USERNAME, PASSWORD),
-        verify=True,
+        timeout=TIMEOUT,
         headers=POST_HEADERS)
     return result.json()
 
 
+def get_paged(location, json_data=None, per_page=None, prefetch=True):
+    """Yield every result of a paged Katello/Foreman list API call.
+
+    'json_data' is a dict of search parameters for the list call, and 'per_page'
+    defaults to the configured PAGESIZE. Pages are fetched lazily as the results
+    are consumed. With 'prefetch' set the next page is requested in the background
+    while the results of the current page are being processed.
+    """
+    if per_page is None:
+        per_page = PAGESIZE
+    params = dict(json_data or {})
+    params['per_page'] = per_page
+
+    def fetch(page, holder, errors):
+        try:
+            params_page = dict(params)
+            params_page['page'] = page
+            holder.append(get_p_json(location, json.dumps(params_page)))
+        except: # pylint: disable-msg=W0702
+            errors.append(sys.exc_info())
+
+    page = 1
+    holder = []
+    errors = []
+    fetch(page, holder, errors)
+    count = 0
+    while True:
+        # Any error fetching the page is raised here, rather than returning a short list
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        result = holder.pop()
+        results = result.get('results', [])
+        subtotal = result.get('subtotal', result.get('total', 0))
+        count = count + len(results)
+        # The server may cap per_page, so keep going until every result has been read
+        more = len(results) > 0 and count < subtotal
+
+        page = page + 1
+        if more and prefetch:
+            worker = threading.Thread(target=fetch, args=(page, holder, errors))
+            worker.daemon = True
+            worker.start()
+
+        for item in results:
+            yield item
+
+        if not more:
+            break
+        if prefetch:
+            worker.join()
+        else:
+            fetch(page, holder, errors)
+
+
+def run_concurrent(func, items, workers=None):
+    """Call func on each of the items using a pool of worker threads.
+
+    At most 'workers' calls (default POOLSIZE, matching the API connection pool)
+    run at once. Returns the results in the same order as the items. If any call
+    raises, the first exception is re-raised once all workers have finished.
+    """
+    if workers is None:
+        workers = POOLSIZE
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    work = Queue.Queue()
+    for index, item in enumerate(items):
+        work.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except: # pylint: disable-msg=W0702
+                errors.append(sys.exc_info())
+
+    threads = []
+    for i in range(min(workers, len(items))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+def get_repositories(repo_ids, version_ids):
+    """Return the details of the given repository IDs as a dict keyed by ID.
+
+    Repositories are read in bulk from the repository list of each of the content
+    view versions in 'version_ids' (the versions the repo IDs were taken from), so
+    only the repositories of those versions are listed. The listings are fetched
+    concurrently. Any repos that are not found in them are fetched individually.
+    """
+    wanted = set(repo_ids)
+    repos = {}
+    if not wanted:
+        return repos
+
+    listings = run_concurrent(
+        lambda version_id: list(get_paged(KATELLO_API + "repositories/",
+            {"content_view_version_id": version_id}, prefetch=False)), set(version_ids))
+    for listing in listings:
+        for repo in listing:
+            # Older Satellite versions return a reduced set of details in the listing
+            if repo['id'] in wanted and set(REPO_DETAIL_KEYS).issubset(repo):
+                repos[repo['id']] = repo
+
+    missing = [repo_id for repo_id in wanted if repo_id not in repos]
+    if missing:
+        msg = "Fetching details of " + str(len(missing)) + " repositories individually"
+        log_msg(msg, 'DEBUG')
+        results = run_concurrent(
+            lambda repo_id: get_json(KATELLO_API + "repositories/" + str(repo_id)), missing)
+        for repo_id, repo in zip(missing, results):
+            repos[repo_id] = repo
+
+    return repos
+
+
 def valid_date(indate):
     """Check date format is valid."""
     try:
@@ -180,7 +398,11 @@ def valid_date(indate):
 def sha256sum(filename):
     """Perform sha256sum of given file."""
     f_name = open(filename, 'rb')
-    shasum = (sha256(f_name.read()).hexdigest(), filename)
+    digest = sha256()
+    for block in iter(lambda: f_name.read(1048576), ''):
+        digest.update(block)
+    f_name.close()
+    shasum = (digest.hexdigest(), filename)
     return shasum
 
 
@@ -196,10 +418,78 @@ def disk_usage(path):
     return round(percent, 1)
 
 
+def disk_free(path):
+    """Return the space available to us on the filesystem holding path, in bytes.
+
+    If path does not exist yet the nearest existing parent directory is used.
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+# Lookups of organisations, products, environments and content views made during this run
+CACHE = {}
+CACHE_LOCK = threading.RLock()
+
+
+def cached(key, fetch, ttl=None):
+    """Return the cached value for 'key', calling fetch() if it is missing or expired.
+
+    Values are kept for 'ttl' seconds (default CACHE_TTL) for the life of the
+    running script, so each lookup is only made once per run.
+    """
+    if ttl is None:
+        ttl = CACHE_TTL
+    with CACHE_LOCK:
+        if key in CACHE and time.time() - CACHE[key][0] < ttl:
+            return CACHE[key][1]
+        value = fetch()
+        CACHE[key] = (time.time(), value)
+        return value
+
+
+def invalidate_cache(kind=None, org_id=None):
+    """Drop cached lookups of the given kind (all if None), optionally for one org.
+
+    Keys are tuples of (kind, org), e.g. ('content_views', 1).
+    """
+    with CACHE_LOCK:
+        for key in CACHE.keys():
+            if (kind is None or key[0] == kind) and (org_id is None or key[1] == org_id):
+                del CACHE[key]
+
+
+def get_org(org_name):
+    """Return the details of the given organisation."""
+    return cached(('org', org_name),
+        lambda: get_json(SAT_API + "organizations/" + org_name))
+
+
+def get_products(org_id):
+    """Return the list of products in the given organisation."""
+    return cached(('products', org_id),
+        lambda: list(get_paged(KATELLO_API + "/products/", {"organization_id": org_id})))
+
+
+def get_environments(org_id):
+    """Return the list of lifecycle environments in the given organisation."""
+    return cached(('environments', org_id),
+        lambda: list(get_paged(SAT_API + "organizations/" + str(org_id) + "/environments/")))
+
+
+def get_content_views(org_id):
+    """Return the list of content views in the given organisation."""
+    return cached(('content_views', org_id),
+        lambda: list(get_paged(KATELLO_API + "organizations/" + str(org_id) + "/content_views/")))
+
+
 def get_org_id(org_name):
     """Return the Organisation ID for a given Org Name."""
     # Check if our organization exists, and extract its ID
-    org = get_json(SAT_API + "organizations/" + org_name)
+    org = get_org(org_name)
     # If the requested organization is not found, exit
     if org.get('error', None):
         msg = "Organization '%s' does not exist." % org_name
@@ -217,7 +507,7 @@ def get_org_id(org_name):
 def get_org_label(org_name):
     """Return the Organisation label for a given Org Name."""
     # Check if our organization exists, and extract its label
-    org = get_json(SAT_API + "organizations/" + org_name)
+    org = get_org(org_name)
     # If the requested organization is not found, exit
     if org.get('error', None):
         msg = "Organization '%s' does not exist." % org_name
@@ -232,6 +522,201 @@ def get_org_label(org_name):
     return org_label
 
 
+class StateStore(object):
+    """Persistent script state, held in a SQLite database in the var directory.
+
+    Export times, export/import history, shipped files, promotion dates and
+    checkpoint journals are kept in indexed tables and updated in transactions,
+    so a crash can never leave a half written state file. Any state pickles
+    left by earlier versions of the scripts are migrated when the store is opened.
+    """
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS export_times (ename TEXT, repo TEXT, exported TEXT, "
+        "PRIMARY KEY (ename, repo))",
+        "CREATE TABLE IF NOT EXISTS export_history (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "ename TEXT, dataset TEXT)",
+        "CREATE INDEX IF NOT EXISTS export_history_ename ON export_history (ename, id)",
+        "CREATE TABLE IF NOT EXISTS shipped (ename TEXT, path TEXT, sha256 TEXT, "
+        "PRIMARY KEY (ename, path))",
+        "CREATE TABLE IF NOT EXISTS imports (id INTEGER PRIMARY KEY AUTOINCREMENT, dataset TEXT)",
+        "CREATE INDEX IF NOT EXISTS imports_dataset ON imports (dataset)",
+        "CREATE TABLE IF NOT EXISTS promotions (env TEXT PRIMARY KEY, promoted TEXT)",
+        "CREATE TABLE IF NOT EXISTS checkpoints (name TEXT PRIMARY KEY, data BLOB)",
+        "CREATE TABLE IF NOT EXISTS migrated (filename TEXT PRIMARY KEY)",
+        "CREATE TABLE IF NOT EXISTS export_sizes (ename TEXT, repo TEXT, units INTEGER, "
+        "unit_size INTEGER, PRIMARY KEY (ename, repo))",
+    ]
+
+    def __init__(self, vardir):
+        if not os.path.exists(vardir):
+            os.makedirs(vardir)
+        self.vardir = vardir
+        self.conn = sqlite3.connect(os.path.join(vardir, 'state.db'))
+        self.conn.text_factory = str
+        with self.conn:
+            for statement in self.SCHEMA:
+                self.conn.execute(statement)
+        self.__migrate()
+
+    def __migrate(self):
+        """Load the contents of any state pickles that have not been migrated yet.
+
+        These are the export times, export history, import history and promotion
+        pickles written by earlier versions of the scripts.
+        """
+        for path in sorted(glob.glob(os.path.join(self.vardir, '*.pkl'))):
+            filename = os.path.basename(path)
+            name = filename[:-4]
+            if not (name.startswith('exports_') or name.startswith('exporthistory_') or
+                    name in ('imports', 'promotions')):
+                continue
+            if self.conn.execute("SELECT 1 FROM migrated WHERE filename = ?",
+                    (filename,)).fetchone():
+                continue
+            data = pickle.load(open(path, 'rb'))
+            with self.conn:
+                if name.startswith('exports_'):
+                    self.__put_export_times(name[8:], data)
+                elif name.startswith('exporthistory_'):
+                    for dataset in data:
+                        self.conn.execute("INSERT INTO export_history (ename, dataset) "
+                            "VALUES (?, ?)", (name[14:], dataset))
+                elif name == 'imports':
+                    # The original imports pickle was a whitespace separated string
+                    if isinstance(data, str):
+                        data = data.split()
+                    for dataset in data:
+                        self.conn.execute("INSERT INTO imports (dataset) VALUES (?)", (dataset,))
+                elif name == 'promotions':
+                    for env, promoted in data.iteritems():
+                        self.conn.execute("INSERT OR REPLACE INTO promotions VALUES (?, ?)",
+                            (env, promoted))
+                self.conn.execute("INSERT INTO migrated VALUES (?)", (filename,))
+            msg = "Migrated " + filename + " into the state database"
+            log_msg(msg, 'DEBUG')
+
+    def __put_export_times(self, ename, export_times):
+        for repo, exported in export_times.iteritems():
+            self.conn.execute("INSERT OR REPLACE INTO export_times VALUES (?, ?, ?)",
+                (ename, repo, exported))
+
+    def __put_shipped(self, ename, files):
+        for path, shasum in files.iteritems():
+            self.conn.execute("INSERT OR REPLACE INTO shipped VALUES (?, ?, ?)",
+                (ename, path, shasum))
+
+    def __put_checkpoint(self, name, checkpoint):
+        self.conn.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?)",
+            (name, sqlite3.Binary(pickle.dumps(checkpoint, pickle.HIGHEST_PROTOCOL))))
+
+    def get_export_times(self, ename):
+        """Return the last export time of each repo in an export set, keyed by repo."""
+        return dict(self.conn.execute("SELECT repo, exported FROM export_times WHERE ename = ?",
+            (ename,)).fetchall())
+
+    def get_last_export(self, ename, repo):
+        """Return the last export time of a single repo in an export set, or None."""
+        row = self.conn.execute("SELECT exported FROM export_times WHERE ename = ? AND repo = ?",
+            (ename, repo)).fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def set_export_times(self, ename, export_times):
+        """Record the export time of each repo in export_times."""
+        with self.conn:
+            self.__put_export_times(ename, export_times)
+
+    def get_export_history(self, ename):
+        """Return the list of datasets exported for an export set, oldest first."""
+        return [row[0] for row in self.conn.execute(
+            "SELECT dataset FROM export_history WHERE ename = ? ORDER BY id", (ename,))]
+
+    def add_export_history(self, ename, dataset):
+        """Append a completed export dataset to the export history."""
+        with self.conn:
+            self.conn.execute("INSERT INTO export_history (ename, dataset) VALUES (?, ?)",
+                (ename, dataset))
+
+    def get_export_sizes(self, ename):
+        """Return the content count and bytes exported per content unit of each repo
+        at its last export, as a dict of repo to (units, unit_size)."""
+        return dict([(row[0], (row[1], row[2])) for row in self.conn.execute(
+            "SELECT repo, units, unit_size FROM export_sizes WHERE ename = ?", (ename,))])
+
+    def set_export_sizes(self, ename, sizes):
+        """Record the (units, unit_size) of each repo in the 'sizes' dict."""
+        with self.conn:
+            for repo, (units, unit_size) in sizes.iteritems():
+                self.conn.execute("INSERT OR REPLACE INTO export_sizes VALUES (?, ?, ?, ?)",
+                    (ename, repo, units, unit_size))
+
+    def get_shipped(self, ename):
+        """Return the files shipped for an export set as a dict of path to sha256sum."""
+        return dict(self.conn.execute("SELECT path, sha256 FROM shipped WHERE ename = ?",
+            (ename,)).fetchall())
+
+    def add_shipped(self, ename, files):
+        """Record the sha256sum of each shipped file in the 'files' dict."""
+        with self.conn:
+            self.__put_shipped(ename, files)
+
+    def get_imports(self):
+        """Return the list of imported datasets, oldest first."""
+        return [row[0] for row in self.conn.execute("SELECT dataset FROM imports ORDER BY id")]
+
+    def get_last_import(self):
+        """Return the last imported dataset, or None."""
+        row = self.conn.execute("SELECT dataset FROM imports ORDER BY id DESC LIMIT 1").fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def is_imported(self, dataset):
+        """Return True if the dataset has been imported before."""
+        return self.conn.execute("SELECT 1 FROM imports WHERE dataset = ?",
+            (dataset,)).fetchone() is not None
+
+    def add_import(self, dataset):
+        """Append a completed import dataset to the import history."""
+        with self.conn:
+            self.conn.execute("INSERT INTO imports (dataset) VALUES (?)", (dataset,))
+
+    def set_imports(self, datasets):
+        """Replace the import history with the given list of datasets."""
+        with self.conn:
+            self.conn.execute("DELETE FROM imports")
+            for dataset in datasets:
+                self.conn.execute("INSERT INTO imports (dataset) VALUES (?)", (dataset,))
+
+    def get_promotions(self):
+        """Return the last promotion date of each environment, keyed by environment."""
+        return dict(self.conn.execute("SELECT env, promoted FROM promotions").fetchall())
+
+    def set_promotion(self, env, promoted):
+        """Record the promotion date of an environment."""
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO promotions VALUES (?, ?)", (env, promoted))
+
+    def get_checkpoint(self, name):
+        """Return the named checkpoint journal, or None if there is none."""
+        row = self.conn.execute("SELECT data FROM checkpoints WHERE name = ?", (name,)).fetchone()
+        if row:
+            return pickle.loads(str(row[0]))
+        return None
+
+    def put_checkpoint(self, name, checkpoint):
+        """Write the named checkpoint journal."""
+        with self.conn:
+            self.__put_checkpoint(name, checkpoint)
+
+    def clear_checkpoint(self, name):
+        """Remove the named checkpoint journal."""
+        with self.conn:
+            self.conn.execute("DELETE FROM checkpoints WHERE name = ?", (name,))
+
+
 class ProgressBar:
     """A progress bar representing percent complete.
     
@@ -272,6 +757,49 @@ class ProgressBar:
         return str(self.prog_bar)
 
 
+def poll_tasks(task_ids):
+    """Return the current status of the given task IDs as a dict keyed by ID.
+
+    All tasks are fetched with a single search query. Any task not returned by
+    the search is queried individually.
+    """
+    search = " or ".join(["id = " + str(task_id) for task_id in task_ids])
+    statuses = {}
+    for task in get_paged(FOREMAN_API + "tasks/", {"search": search}):
+        statuses[task['id']] = task
+    for task_id in task_ids:
+        if task_id not in statuses:
+            statuses[task_id] = get_json(FOREMAN_API + "tasks/" + str(task_id))
+    return statuses
+
+
+def next_poll_interval(interval, changed):
+    """Return the time to wait before the next task poll.
+
+    Polling restarts at POLL_MIN whenever a task has changed, and backs off
+    towards POLL_MAX while nothing is happening.
+    """
+    if changed:
+        return POLL_MIN
+    return min(POLL_MAX, interval * 2)
+
+
+def log_task_progress(name, task_id, ref, status):
+    """Append a task status change to the JSON-lines progress log."""
+    record = {
+        'time': datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S'),
+        'name': name,
+        'task': task_id,
+        'ref': ref,
+        'state': status['state'],
+        'result': status['result'],
+        'progress': round(status['progress'] * 100, 1),
+    }
+    f_handle = open(LOGDIR + '/task_progress.log', 'a')
+    f_handle.write(json.dumps(record) + '\n')
+    f_handle.close()
+
+
 def wait_for_task(task_id, label):
     """Wait for the given task ID to complete.
 
@@ -283,15 +811,22 @@ def wait_for_task(task_id, label):
     log_msg(msg, 'INFO')
     # Force the status message to be shown to the user
     sys.stdout.flush()
+    interval = POLL_MIN
+    last = None
     while True:
         info = get_json(FOREMAN_API + "tasks/" + str(task_id))
+        current = (info['state'], info['result'], info['progress'])
+        if current != last:
+            log_task_progress(label, task_id, label, info)
         if info['state'] == 'paused' and info['result'] == 'error':
             msg = "Error with " + label + " " + str(task_id)
             log_msg(msg, 'ERROR')
             break
         if info['pending'] != 1:
             break
-        sleep(30)
+        interval = next_poll_interval(interval, current != last)
+        last = current
+        sleep(interval)
 
 
 def get_task_status(task_id):
@@ -309,67 +844,53 @@ def get_task_status(task_id):
 def watch_tasks(task_list, ref_list, task_name, quiet):
     """Watch the status of tasks provided in taskList.
 
-    Loops until all tasks in the list have completed.
+    Loops until all tasks in the list have completed. The status of all tasks is
+    fetched in one query per poll. On a terminal only the lines of tasks that
+    have changed are redrawn. In quiet mode, or when not on a terminal, nothing
+    is drawn and status changes are written to the JSON-lines progress log.
     """
-
-    # Seed the pendingList dictionary so all tasks are pending
-    pending_list = {}
+    if not task_list:
+        print "ERROR (watchTasks): no tasks passed to us"
+        return
+
+    render = not quiet and sys.stdout.isatty()
+    pending = list(task_list)
+    last = {}
+    lines = []
+    bars = {}
     for task_id in task_list:
-        pending_list[task_id] = "true"
-
-    # Loop through each task and check current status
-    do_loop = True
-    sleep_time = 10
+        bars[task_id] = ProgressBar(100)
     failure = False
-    while do_loop:
-        if len(task_list) >= 1:
-            # Don't render progress bars if in quiet mode
-            if not quiet:
-                os.system('clear')
-                print BOLD + task_name + ENDC
-
-            for task_id in task_list:
-
-                # Whilst there are pending tasks, loop through the task status
-                if 'true' in pending_list.values():
-                    # Query API to get status of current task
-                    status = get_json(
-                        FOREMAN_API + "tasks/" + str(task_id))
-
-                    # The result we get back is a floating number - we need to convert to a %
-                    pct_done = (status['progress'] * 100)
-                    pct_done1 = round(pct_done, 1)
-
-                    if status['result'] == 'success':
-                        colour = GREEN
-                    elif status['result'] == 'pending':
-                        colour = YELLOW
-                    else:
-                        colour = RED
-                        failure = True
-
-                    # Call the progress bar class
-                    p = ProgressBar(100)
-                    p.update_time(pct_done1)
-                    # Don't render progress bars if in quiet mode
-                    if not quiet:
-                        print colour + str(ref_list[task_id]) + ':' + ENDC
-                        print p
-
-                    if status['result'] != "pending":
-                        # Update the pendingList dictionary to say this task is done
-                        pending_list[task_id] = "false"
-                else:
-                    # All tasks are complete - end the loop
-                    do_loop = False
-                    sleep_time = 0
-                    continue
-
-            # Sleep for 10 seconds between checks
-            time.sleep(sleep_time)
-        else:
-            do_loop = False
-            print "ERROR (watchTasks): no tasks passed to us"
+    interval = POLL_MIN
+
+    if render:
+        print BOLD + task_name + ENDC
+
+    while pending:
+        statuses = poll_tasks(pending)
+        changed = False
+        for task_id in list(pending):
+            status = statuses[task_id]
+            current = (status['state'], status['result'], status['progress'])
+            if current == last.get(task_id):
+                continue
+            changed = True
+            last[task_id] = current
+            if not render:
+                log_task_progress(task_name, task_id, ref_list[task_id], status)
+
+            if status['result'] not in ('success', 'pending'):
+                failure = True
+            if status['result'] != "pending":
+                # This task is done
+                pending.remove(task_id)
+
+        if render:
+            lines = draw_tasks(task_list, ref_list, last, bars, lines)
+
+        if pending:
+            interval = next_poll_interval(interval, changed)
+            time.sleep(interval)
 
     # All tasks are complete if we get here.
     msg = task_name + " complete"
@@ -380,101 +901,229 @@ def watch_tasks(task_list, ref_list, task_name, quiet):
         print GREEN + "\nAll tasks complete" + ENDC
 
 
+def draw_tasks(task_list, ref_list, last, bars, drawn):
+    """Draw the progress of each task, rewriting only the lines that changed.
+
+    'drawn' is the list of lines displayed by the previous call. Returns the
+    list of lines now displayed.
+    """
+    lines = []
+    for task_id in task_list:
+        state, result, progress = last.get(task_id, ('', 'pending', 0))
+        if result == 'success':
+            colour = GREEN
+        elif result == 'pending':
+            colour = YELLOW
+        else:
+            colour = RED
+        # The result we get back is a floating number - we need to convert to a %
+        bars[task_id].update_time(round(progress * 100, 1))
+        lines.append(colour + str(ref_list[task_id]) + ':' + ENDC)
+        lines.append(str(bars[task_id]))
+
+    # Move the cursor back to the top of our block, then step over unchanged lines
+    if drawn:
+        sys.stdout.write(chr(27) + '[' + str(len(drawn)) + 'A')
+    for index, line in enumerate(lines):
+        if index < len(drawn) and drawn[index] == line:
+            sys.stdout.write('\n')
+        else:
+            sys.stdout.write(chr(27) + '[2K' + line + '\n')
+    sys.stdout.flush()
+    return lines
+
+
+def clear_tasks(drawn):
+    """Erase the task progress block drawn by draw_tasks, so other output can follow."""
+    if drawn:
+        sys.stdout.write(chr(27) + '[' + str(len(drawn)) + 'A' + chr(27) + '[J')
+        sys.stdout.flush()
+    return []
+
+
+def run_tasks(items, start, finish, limit, task_name, quiet, ready=None):
+    """Keep up to 'limit' tasks running from a queue of work items.
+
+    Items are started in order by calling 'start', which returns the task ID and
+    the reference to show for it, or None if no task was started. An item is held
+    back while 'ready' returns False for it, unless nothing is running that it
+    could be waiting for. 'finish' is called with the item and the final task
+    status as soon as each task finishes. All running tasks are fetched in one
+    query per poll and status changes are written to the JSON-lines progress log.
+    On a terminal the running tasks are drawn as in watch_tasks.
+    """
+    render = not quiet and sys.stdout.isatty()
+    queue = list(items)
+    inflight = {}
+    task_list = []
+    ref_list = {}
+    last = {}
+    bars = {}
+    lines = []
+    force = False
+    interval = POLL_MIN
+
+    if render:
+        print BOLD + task_name + ENDC
+
+    while queue or inflight:
+        # Top up the running tasks, clearing the progress block before any output
+        started = False
+        for item in list(queue):
+            if len(inflight) >= limit:
+                break
+            if ready is not None and not force and not ready(item):
+                continue
+            lines = clear_tasks(lines)
+            queue.remove(item)
+            started = True
+            task = start(item)
+            if task is None:
+                continue
+            task_id, ref = task
+            inflight[task_id] = item
+            task_list.append(task_id)
+            ref_list[task_id] = ref
+            bars[task_id] = ProgressBar(100)
+        force = False
+
+        if not inflight:
+            # Nothing is running that the waiting items depend on, so stop waiting
+            if queue and not started:
+                msg = task_name + " - starting the remaining tasks without waiting for" \
+                    + " the tasks they depend on"
+                log_msg(msg, 'WARNING')
+                force = True
+            continue
+
+        running = [tid for tid in task_list if tid in inflight]
+        if render:
+            lines = draw_tasks(running, ref_list, last, bars, lines)
+
+        sleep(interval)
+        statuses = poll_tasks(running)
+        changed = False
+        done = []
+        for task_id in running:
+            info = statuses[task_id]
+            current = (info['state'], info['result'], info['progress'])
+            if current != last.get(task_id):
+                changed = True
+                last[task_id] = current
+                log_task_progress(task_name, task_id, ref_list[task_id], info)
+            if info['state'] == 'paused' and info['result'] == 'error':
+                msg = "Error with " + str(ref_list[task_id]) + " " + str(task_id)
+                log_msg(msg, 'ERROR')
+            elif info['pending'] == 1:
+                continue
+            done.append(task_id)
+
+        if done:
+            lines = clear_tasks(lines)
+        for task_id in done:
+            item = inflight.pop(task_id)
+            finish(item, get_task_status(task_id))
+        interval = next_poll_interval(interval, changed)
+
+
+def get_task_snapshot(refresh=False):
+    """Return an index of the active (planning, running or paused) Foreman tasks.
+
+    The task list is fetched once per run using a server-side state filter, and
+    indexed so that lock checks are dictionary lookups. Use 'refresh' to force a
+    new snapshot to be taken. The snapshot is a dict containing:
+      'action' - tasks keyed by (state, action)
+      'cv'     - (state, action) pairs keyed by content view ID
+      'repo'   - (state, action) pairs keyed by repository label
+    """
+    global TASK_SNAPSHOT
+    if TASK_SNAPSHOT is not None and not refresh:
+        return TASK_SNAPSHOT
+
+    snapshot = {'action': {}, 'cv': {}, 'repo': {}}
+    tasks = get_paged(FOREMAN_API + "tasks/", {"search": ACTIVE_TASK_SEARCH})
+    for task_result in tasks:
+        if task_result['state'] not in ('planning', 'running', 'paused'):
+            continue
+        if task_result['label'] == 'Actions::BulkAction':
+            continue
+        key = (task_result['state'], task_result['humanized']['action'])
+        snapshot['action'].setdefault(key, []).append(task_result)
+
+        task_input = task_result.get('input') or {}
+        if task_input.get('content_view'):
+            snapshot['cv'].setdefault(task_input['content_view']['id'], []).append(key)
+        if task_input.get('repository'):
+            snapshot['repo'].setdefault(task_input['repository']['label'], []).append(key)
+
+    msg = "Task snapshot: " + str(sum([len(x) for x in snapshot['action'].values()])) \
+        + " active tasks"
+    log_msg(msg, 'DEBUG')
+    TASK_SNAPSHOT = snapshot
+    return TASK_SNAPSHOT
+
+
 def check_running_sync():
     """Check for any currently running Sync tasks.
 
     Exits script if any Synchronize or Export tasks are found in a running state.
     """
-    tasks = get_json(
-        FOREMAN_API + "tasks/")
-
-    # From the list of tasks, look for any running sync jobs.
-    # If e have any we exit, as we can't trigger a new sync in this state.
-    for task_result in tasks['results']:
-        if task_result['state'] == 'running' and task_result['label'] != 'Actions::BulkAction':
-            if task_result['humanized']['action'] == 'Synchronize':
-                msg = "Unable to start sync - a Sync task is currently running"
-                log_msg(msg, 'ERROR')
-                sys.exit(1)
-        if task_result['state'] == 'paused' and task_result['label'] != 'Actions::BulkAction':
-            if task_result['humanized']['action'] == 'Synchronize':
-                msg = "Unable to start sync - a Sync task is paused. Resume any paused sync tasks."
-                log_msg(msg, 'ERROR')
-                sys.exit(1)
+    snapshot = get_task_snapshot()
+
+    # If we have any running sync jobs we exit, as we can't trigger a new sync in this state.
+    if ('running', 'Synchronize') in snapshot['action']:
+        msg = "Unable to start sync - a Sync task is currently running"
+        log_msg(msg, 'ERROR')
+        sys.exit(1)
+    if ('paused', 'Synchronize') in snapshot['action']:
+        msg = "Unable to start sync - a Sync task is paused. Resume any paused sync tasks."
+        log_msg(msg, 'ERROR')
+        sys.exit(1)
+
 
+def planning_lock(snapshot, ignore=()):
+    """Return the kind of any CV locking task in planning state in the snapshot, or None.
 
-def check_running_publish(cvid, desc):
+    Tasks whose IDs are in 'ignore' (those started by this run) are not locks.
+    """
+    for action, (planning, locked_by) in CV_LOCK_ACTIONS.iteritems():
+        for task_result in snapshot['action'].get(('planning', action), []):
+            if task_result['id'] not in ignore:
+                return planning
+    return None
+
+
+def check_running_publish(cvid, desc, ignore=()):
     """Check for any currently running Promotion/Publication tasks.
 
-    Exits script if any Publish/Promote tasks are found in a running state.
+    Returns True if any Publish/Promote/Remove tasks lock the given content view.
+    A planning-state task is usually about to start, so the task snapshot is
+    refreshed (up to PLANNING_RETRIES times) to see it move on before it is
+    treated as a lock. The task IDs in 'ignore' are never treated as a lock.
     """
-    #pylint: disable-msg=R0912,R0914,R0915
-    tasks = get_json(
-        FOREMAN_API + "tasks/")
-
-    # From the list of tasks, look for any running sync jobs.
-    # If e have any we exit, as we can't trigger a new sync in this state.
-    for task_result in tasks['results']:
-        if task_result['state'] == 'planning' and task_result['label'] != 'Actions::BulkAction':
-            if task_result['humanized']['action'] == 'Publish':
-                msg = "Unable to start '" + desc + "': A publish task is in planning state, cannot determine if it is for this CV"
-                log_msg(msg, 'WARNING')
-                locked = True
-                return locked
-        if task_result['state'] == 'running' and task_result['label'] != 'Actions::BulkAction':
-            if task_result['humanized']['action'] == 'Publish':
-                if task_result['input']['content_view']['id'] == cvid:
-                    msg = "Unable to start '" + desc + "': content view is locked by a running Publish task"
-                    log_msg(msg, 'WARNING')
-                    locked = True
-                    return locked
-        if task_result['state'] == 'paused' and task_result['label'] != 'Actions::BulkAction':
-            if task_result['humanized']['action'] == 'Publish':
-                if task_result['input']['content_view']['id'] == cvid:
-                    msg = "Unable to start '" + desc + "': content view is locked by a paused Publish task"
-                    log_msg(msg, 'WARNING')
-                    locked = True
-                    return locked
-        if task_result['state'] == 'planning' and task_result['label'] != 'Actions::BulkAction':
-            if task_result['humanized']['action'] == 'Promotion' or task_result['humanized']['action'] == 'Promote':
-                msg = "Unable to start '" + desc + "': A promotion task is in planning state, cannot determine if it is for this CV"
-                log_msg(msg, 'WARNING')
-                locked = True
-                return locked
-        if task_result['state'] == 'running' and task_result['label'] != 'Actions::BulkAction':
-            if task_result['humanized']['action'] == 'Promotion' or task_result['humanized']['action'] == 'Promote':
-                if task_result['input']['content_view']['id'] == cvid:
-                    msg = "Unable to start '" + desc + "': content view is locked by a running Promotion task"
-                    log_msg(msg, 'WARNING')
-                    locked = True
-                    return locked
-        if task_result['state'] == 'paused' and task_result['label'] != 'Actions::BulkAction':
-            if task_result['humanized']['action'] == 'Promotion' or task_result['humanized']['action'] == 'Promote':
-                if task_result['input']['content_view']['id'] == cvid:
-                    msg = "Unable to start '" + desc + "': content view is locked by a paused Promotion task"
-                    log_msg(msg, 'WARNING')
-                    locked = True
-                    return locked
-        if task_result['state'] == 'planning' and task_result['label'] != 'Actions::BulkAction':
-            if task_result['humanized']['action'] == 'Remove Versions and Associations':
-                msg = "Unable to start '" + desc + "': A remove task is in planning state, cannot determine if it is for this CV"
-                log_msg(msg, 'WARNING')
-                locked = True
-                return locked
-        if task_result['state'] == 'running' and task_result['label'] != 'Actions::BulkAction':
-            if task_result['humanized']['action'] == 'Remove Versions and Associations':
-                if task_result['input']['content_view']['id'] == cvid:
-                    msg = "Unable to start '" + desc + "': content view is locked by a running CV deletion task"
-                    log_msg(msg, 'WARNING')
-                    locked = True
-                    return locked
-        if task_result['state'] == 'paused' and task_result['label'] != 'Actions::BulkAction':
-            if task_result['humanized']['action'] == 'Remove Versions and Associations':
-                if task_result['input']['content_view']['id'] == cvid:
-                    msg = "Unable to start '" + desc + "': content view is locked by a paused CV deletion task"
-                    log_msg(msg, 'WARNING')
-                    locked = True
-                    return locked
+    snapshot = get_task_snapshot()
+    retries = 0
+    while planning_lock(snapshot, ignore) and retries < PLANNING_RETRIES:
+        sleep(POLL_MIN)
+        snapshot = get_task_snapshot(refresh=True)
+        retries = retries + 1
+
+    # A task in planning state has no input yet, so we can't tell which CV it is for
+    planning = planning_lock(snapshot, ignore)
+    if planning:
+        msg = "Unable to start '" + desc + "': A " + planning \
+            + " task is in planning state, cannot determine if it is for this CV"
+        log_msg(msg, 'WARNING')
+        locked = True
+        return locked
+
+    for state, action in snapshot['cv'].get(cvid, []):
+        if action in CV_LOCK_ACTIONS and state in ('running', 'paused'):
+            msg = "Unable to start '" + desc + "': content view is locked by a " + state \
+                + " " + CV_LOCK_ACTIONS[action][1] + " task"
+            log_msg(msg, 'WARNING')
+            locked = True
+            return locked
 
 
 def query_yes_no(question, default="yes"):
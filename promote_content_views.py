@@ -14,7 +14,6 @@ import sys
 import os
 import argparse
 import datetime
-import pickle
 import simplejson as json
 import helpers
 
@@ -28,13 +27,12 @@ except ImportError:
 # Get the details about the environments
 def get_envs(org_id):
     """Get list of environments for the given org."""
-    envs = helpers.get_json(
-        helpers.SAT_API + "organizations/" + str(org_id) + "/environments/")
+    envs = helpers.get_environments(org_id)
 
     # ... and add them to a dictionary, with respective 'Prior' environment
     env_list = {}
     prior_list = {}
-    for env in envs['results']:
+    for env in envs:
         env_list[env['name']] = env['id']
         if env['name'] == "Library":
             prior = 0
@@ -66,13 +64,12 @@ def get_cv(org_id, target_env, env_list, prior_list, promote_list):
         source_env_id = prior_list[target_env_id]
 
     # Query API to get all content views for our org
-    cvs = helpers.get_json(
-        helpers.KATELLO_API + "organizations/" + str(org_id) + "/content_views/")
+    cvs = helpers.get_content_views(org_id)
     ver_list = {}
     ver_descr = {}
     ver_version = {}
 
-    for cv_result in cvs['results']:
+    for cv_result in cvs:
         # We will never promote to/from the DOV
         if cv_result['name'] != "Default Organization View":
 
@@ -180,6 +177,9 @@ def promote(target_env, ver_list, ver_descr, ver_version, env_list, prior_list,
             # Monitor the status of the promotion tasks
             helpers.watch_tasks(task_list, ref_list, task_name, quiet)
 
+            # The cached content views no longer show the promoted environments
+            helpers.invalidate_cache('content_views')
+
     # Exit in the case of a dry-run
     if dry_run:
         sys.exit(2)
@@ -234,12 +234,8 @@ def main(args):
     dry_run = args.dryrun
 
     # Load the promotion history
-    if not os.path.exists(vardir + '/promotions.pkl'):
-        if not os.path.exists(vardir):
-            os.makedirs(vardir)
-        phistory = {}
-    else:
-        phistory = pickle.load(open(vardir + '/promotions.pkl', 'rb'))
+    state = helpers.StateStore(vardir)
+    phistory = state.get_promotions()
 
     # Read the promotion history if --last requested
     if args.last:
@@ -290,8 +286,7 @@ def main(args):
         args.quiet, args.forcemeta)
 
     # Add/Update the promotion history dictionary so we can check when we last promoted
-    phistory[target_env] = datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d')
-    pickle.dump(phistory, open(vardir + '/promotions.pkl', 'wb'))
+    state.set_promotion(target_env, datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d'))
 
     # Run the mailout
     if helpers.MAILOUT:
@@ -13,22 +13,29 @@ import sys
 import os
 import argparse
 import datetime
-import pickle
+import collections
 import simplejson as json
 import helpers
 
 
 def get_cv(org_id, publish_list):
-    """Get the content views."""
+    """Get the content views.
+
+    Composite content views are listed after the component views, along with the
+    IDs of their components that are also being published.
+    """
 
     # Query API to get all content views for our org
-    cvs = helpers.get_json(
-        helpers.KATELLO_API + "organizations/" + str(org_id) + "/content_views/")
-    ver_list = {}
+    cvs = helpers.get_content_views(org_id)
+    ver_list = collections.OrderedDict()
     ver_descr = {}
     ver_version = {}
+    ver_components = {}
+
+    # Sort the CVs so that composites are published after their components
+    cv_results = sorted(cvs, key=lambda k: k.get(u'composite', False))
 
-    for cv_result in cvs['results']:
+    for cv_result in cv_results:
         # We will never publish the DOV
         if cv_result['name'] != "Default Organization View":
 
@@ -46,19 +53,47 @@ def get_cv(org_id, publish_list):
             ver_list[cv_result['id']] = cv_result['id']
             ver_descr[cv_result['id']] = cv_result['name']
             ver_version[cv_result['id']] = cv_result['next_version']
-
-    return ver_list, ver_descr, ver_version
-
-
-def publish(ver_list, ver_descr, ver_version, dry_run, runuser, description, quiet, forcemeta):
-    """Publish Content View."""
+            ver_components[cv_result['id']] = get_component_ids(cv_result)
+
+    # A composite only waits for the components that are being published with it
+    for cvid in ver_components:
+        ver_components[cvid] = [x for x in ver_components[cvid] if x in ver_list and x != cvid]
+
+    return ver_list, ver_descr, ver_version, ver_components
+
+
+def get_component_ids(cv_result):
+    """Return the IDs of the component views of a composite content view."""
+    component_ids = []
+    if not cv_result.get('composite'):
+        return component_ids
+    # Satellite 6.2 lists the component versions, 6.3 also lists the component views
+    for component in cv_result.get('components') or []:
+        if component.get('content_view_id'):
+            component_ids.append(component['content_view_id'])
+        elif component.get('content_view'):
+            component_ids.append(component['content_view']['id'])
+    for component in cv_result.get('content_view_components') or []:
+        if component.get('content_view'):
+            component_ids.append(component['content_view']['id'])
+    return list(set(component_ids))
+
+
+def publish(ver_list, ver_descr, ver_version, ver_components, dry_run, runuser, description,
+        quiet, forcemeta):
+    """Publish Content View.
+
+    Up to PUBLISHBATCH publish tasks are kept running at once by helpers.run_tasks.
+    As soon as any task finishes the next content view is started. A composite
+    view is only started once all of its components being published in this run
+    have finished, and is not published at all if any of them failed.
+    """
 
     # Set the task name to be displayed in the task monitoring stage
     task_name = "Publish content view to Library"
 
     # Now we have all the info needed, we can actually trigger the publish.
     task_list = []
-    ref_list = {}
 
     # Catch scenario that no CV versions are found matching publish criteria
     if not ver_list:
@@ -70,54 +105,93 @@ def publish(ver_list, ver_descr, ver_version, dry_run, runuser, description, qui
             helpers.mailout(helpers.MAILSUBJ_FP, output)
         sys.exit(1)
 
-    # Break repos to publish into batches as configured in config.yml
-    cvchunks = [ ver_list.keys()[i:i+helpers.PUBLISHBATCH] for i in range(0, len(ver_list), helpers.PUBLISHBATCH) ]
-
-    # Loop through the smaller subsets of repo id's
-    for chunk in cvchunks:
-        for cvid in chunk:
-
-            # Check if there is a publish/promote already running on this content view
-            locked = helpers.check_running_publish(ver_list[cvid], ver_descr[cvid])
-
-            if not locked:
-                msg = "Publishing '" + str(ver_descr[cvid]) + "' Version " + str(ver_version[cvid]) + ".0"
-                helpers.log_msg(msg, 'INFO')
-                print helpers.HEADER + msg + helpers.ENDC
-
-            if not dry_run and not locked:
-                try:
-                    task_id = helpers.post_json(
-                        helpers.KATELLO_API + "content_views/" + str(ver_list[cvid]) +\
-                        "/publish", json.dumps(
-                            {
-                                "description": description,
-                                "force_yum_metadata_regeneration": str(forcemeta)
-                            }
-                            ))["id"]
-                except Warning:
-                    msg = "Failed to initiate publication of " + str(ver_descr[cvid])
-                    helpers.log_msg(msg, 'WARNING')
-                except KeyError:
-                    msg = "Failed to initiate publication of " + str(ver_descr[cvid])
-                    helpers.log_msg(msg, 'WARNING')
-                else:
-                    task_list.append(task_id)
-                    ref_list[task_id] = ver_descr[cvid]
-
-        # Notify user in the case of a dry-run
-        if dry_run:
-            msg = "Dry run - not actually performing publish"
+    # Content views that have been published, and those that could not be
+    finished = set()
+    failed = set()
+
+    def ready(cvid):
+        return not [x for x in ver_components[cvid] if x not in finished and x not in failed]
+
+    def start(cvid):
+        if [x for x in ver_components[cvid] if x in failed]:
+            msg = "Not publishing '" + str(ver_descr[cvid]) \
+                + "' - a component view failed to publish"
+            helpers.log_msg(msg, 'WARNING')
+            failed.add(cvid)
+            return None
+
+        # Publishing the components may have triggered an auto-publish of the composite
+        if ver_components[cvid]:
+            helpers.get_task_snapshot(refresh=True)
+
+        # Check if there is a publish/promote already running on this content view.
+        # Our own publish tasks may still be in planning state, so they are not locks.
+        locked = helpers.check_running_publish(ver_list[cvid], ver_descr[cvid], task_list)
+
+        if not locked:
+            msg = "Publishing '" + str(ver_descr[cvid]) + "' Version " + str(ver_version[cvid]) + ".0"
+            helpers.log_msg(msg, 'INFO')
+            print helpers.HEADER + msg + helpers.ENDC
+
+        if dry_run or locked:
+            finished.add(cvid)
+            return None
+
+        try:
+            task_id = helpers.post_json(
+                helpers.KATELLO_API + "content_views/" + str(ver_list[cvid]) +\
+                "/publish", json.dumps(
+                    {
+                        "description": description,
+                        "force_yum_metadata_regeneration": str(forcemeta)
+                    }
+                    ))["id"]
+        except Warning:
+            msg = "Failed to initiate publication of " + str(ver_descr[cvid])
             helpers.log_msg(msg, 'WARNING')
+            failed.add(cvid)
+        except KeyError:
+            msg = "Failed to initiate publication of " + str(ver_descr[cvid])
+            helpers.log_msg(msg, 'WARNING')
+            failed.add(cvid)
+        else:
+            task_list.append(task_id)
+            return task_id, ver_descr[cvid]
+
+    def finish(cvid, info):
+        if info['result'] == 'success':
+            finished.add(cvid)
+            msg = "Published '" + ver_descr[cvid] + "'"
+            helpers.log_msg(msg, 'INFO')
+            if not quiet:
+                print helpers.GREEN + msg + helpers.ENDC
         else:
-            # Wait for the tasks to finish
-            helpers.watch_tasks(task_list, ref_list, task_name, quiet)
+            failed.add(cvid)
+            msg = "Publish of '" + ver_descr[cvid] + "' finished with result " + info['result']
+            helpers.log_msg(msg, 'ERROR')
+            if not quiet:
+                print helpers.RED + msg + helpers.ENDC
+
+    helpers.run_tasks(ver_list.keys(), start, finish, helpers.PUBLISHBATCH, task_name,
+        quiet or dry_run, ready)
 
     # Exit in the case of a dry-run
     if dry_run:
+        msg = "Dry run - not actually performing publish"
+        helpers.log_msg(msg, 'WARNING')
         sys.exit(2)
+
+    # All tasks are complete if we get here.
+    msg = task_name + " complete"
+    helpers.log_msg(msg, 'INFO')
+    if failed:
+        print helpers.RED + "\nNot all tasks completed successfully" + helpers.ENDC
     else:
-        return
+        print helpers.GREEN + "\nAll tasks complete" + helpers.ENDC
+
+    # The cached content views no longer show the new versions
+    helpers.invalidate_cache('content_views')
+    return
 
 
 def main(args):
@@ -173,12 +247,8 @@ def main(args):
         description = "Published by " + runuser + "\n via API script"
 
     # Load the promotion history
-    if not os.path.exists(vardir + '/promotions.pkl'):
-        if not os.path.exists(vardir):
-            os.makedirs(vardir)
-        phistory = {}
-    else:
-        phistory = pickle.load(open(vardir + '/promotions.pkl', 'rb'))
+    state = helpers.StateStore(vardir)
+    phistory = state.get_promotions()
 
     # Read the promotion history if --last requested
     if args.last:
@@ -210,15 +280,14 @@ def main(args):
     org_id = helpers.get_org_id(org_name)
 
     # Get the list of Content Views along with the latest view version in each environment
-    (ver_list, ver_descr, ver_version) = get_cv(org_id, publish_list)
+    (ver_list, ver_descr, ver_version, ver_components) = get_cv(org_id, publish_list)
 
     # Publish the content views. Returns a list of task IDs.
-    publish(ver_list, ver_descr, ver_version, dry_run, runuser, description, args.quiet,
-        args.forcemeta)
+    publish(ver_list, ver_descr, ver_version, ver_components, dry_run, runuser, description,
+        args.quiet, args.forcemeta)
 
     # Add/Update the promotion history dictionary so we can check when we last promoted
-    phistory['Library'] = datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d')
-    pickle.dump(phistory, open(vardir + '/promotions.pkl', 'wb'))
+    state.set_promotion('Library', datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d'))
 
     # Run the mailout
     if helpers.MAILOUT:
@@ -10,7 +10,6 @@
 
 import sys, argparse, datetime, os, shutil, pickle, re
 import fnmatch, subprocess, tarfile
-import simplejson as json
 from glob import glob
 import helpers
 
@@ -225,18 +224,14 @@ def main(args):
     # Collect a list of enabled repositories. This is needed for:
     # 1. Matching specific repo exports, and
     # 2. Running import sync per repo on the disconnected side
-    repolist = helpers.get_p_json(
+    repolist = helpers.get_paged(
         helpers.KATELLO_API + "/repositories/",
-        json.dumps(
-                {
-                    "organization_id": org_id,
-                    "per_page": '1000',
-                }
-            )
-        )
+        {
+            "organization_id": org_id,
+        })
 
     # Process each repo
-    for repo_result in repolist['results']:
+    for repo_result in repolist:
         if repo_result['content_type'] == 'puppet':
             # If we have a match, do the export
             if repo_result['label'] == pfrepo:
@@ -10,8 +10,9 @@
 Exports Satellite 6 yum content.
 """
 
-import sys, argparse, datetime, os, shutil, pickle, re
-import fnmatch, subprocess, tarfile
+import sys, argparse, datetime, os, shutil, pickle, re, stat
+import fnmatch, subprocess, tarfile, time, multiprocessing
+from hashlib import sha256
 import simplejson as json
 from glob import glob
 from distutils.dir_util import copy_tree
@@ -23,6 +24,31 @@ except ImportError:
     print "Please install the PyYAML module."
     sys.exit(1)
 
+# Use the faster scandir based directory listing if the module is available
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+
+# Number of RPMs passed to each 'rpm -K' call during the GPG check
+GPGBATCH = 200
+
+# Stages of the export recorded in the checkpoint journal, in the order they complete.
+# Each repo is first recorded as 'exported' once its own export has finished.
+EXPORT_STAGES = ['merged', 'counted', 'gpgchecked', 'archived']
+
+# Assumed size of a content unit (package, file or module) of a repo with no export history,
+# and the allowance made for the repodata of each exported repo
+DEFAULT_UNIT_SIZE = 2 * 1048576
+REPODATA_SIZE = 32 * 1048576
+
+# Headroom added to the export size estimate when checking the available space
+CAPACITY_MARGIN = 1.1
+
+# Set once the check for incomplete syncs has been performed
+incomplete_checked = False
+
 
 # Get details about Content Views and versions
 def get_cv(org_id):
@@ -33,9 +59,7 @@ def get_cv(org_id):
     """
 
     # Query API to get all content views for our org
-    cvs = helpers.get_json(
-        helpers.KATELLO_API + "organizations/" + str(org_id) + "/content_views/")
-    for cv_result in cvs['results']:
+    for cv_result in helpers.get_content_views(org_id):
         if cv_result['name'] == "Default Organization View":
             msg = "CV Name: " + cv_result['name']
             helpers.log_msg(msg, 'DEBUG')
@@ -163,15 +187,51 @@ def export_repo(repo_id, last_export, export_type):
     return str(task_id)
 
 
+def link_or_copy(src, dest):
+    """Place a copy of file src at dest.
+
+    The file is hardlinked if src and dest are on the same filesystem, otherwise
+    it is copied preserving mode and timestamps.
+    """
+    src = os.path.realpath(src)
+    if os.stat(src).st_dev == os.stat(os.path.dirname(dest)).st_dev:
+        try:
+            os.link(src, dest)
+            return
+        except OSError:
+            pass
+    shutil.copy2(src, dest)
+
+
+def copy_files_since(srcdir, outdir, since, always):
+    """Copy the files under srcdir into outdir, keeping the directory structure.
+
+    Symlinks are followed. If 'since' is set, only files with a change time at or
+    after it (seconds since the epoch) are copied, except for file names listed
+    in 'always' which are copied regardless. Returns the list of copied files
+    relative to outdir.
+    """
+    copied = []
+    for dirpath, dirs, files in os.walk(srcdir, followlinks=True):
+        for filename in files:
+            fname = os.path.join(dirpath, filename)
+            if since and filename not in always and os.stat(fname).st_ctime < since:
+                continue
+            relpath = os.path.relpath(fname, srcdir)
+            dest = os.path.join(outdir, relpath)
+            if not os.path.exists(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            link_or_copy(fname, dest)
+            copied.append(relpath)
+    return copied
+
+
 def export_iso(repo_id, repo_path, repo_label, repo_relative, last_export, export_type, satver):
     """Export iso repository.
-    
+
     Takes the repository id and a start time (find newer than value)
     """
     numfiles = 0
-    ISOEXPORTDIR = helpers.EXPORTDIR + '/iso'
-    if not os.path.exists(ISOEXPORTDIR):
-        os.makedirs(ISOEXPORTDIR)
 
     if export_type == 'full':
         msg = "Exporting ISO repository id " + str(repo_id)
@@ -179,14 +239,6 @@ def export_iso(repo_id, repo_path, repo_label, repo_relative, last_export, expor
         msg = "Exporting ISO repository id " + str(repo_id) + " from start date " + last_export
     helpers.log_msg(msg, 'INFO')
 
-
-    # This will currently export ALL ISO, not just the selected repo
-    if export_type == 'full':
-        msg = "Exporting all ISO content"
-    else:
-        msg = "Exporting ISO content from start date " + last_export
-    helpers.log_msg(msg, 'INFO')
-
     msg = "  Copying updated files for export..."
     colx = "{:<70}".format(msg)
     print colx[:70],
@@ -194,58 +246,31 @@ def export_iso(repo_id, repo_path, repo_label, repo_relative, last_export, expor
     # Force the status message to be shown to the user
     sys.stdout.flush()
 
-    if export_type == 'full':
-        os.system('find -L /var/lib/pulp/published/http/isos/*' + repo_path \
-            + ' -type f -exec cp --parents -Lrp {} ' + ISOEXPORTDIR + " \;")
-    else:
-        os.system('find -L /var/lib/pulp/published/http/isos/*' + repo_path \
-            + ' -type f -newerct $(date +%Y-%m-%d -d "' + last_export + '") -exec cp --parents -Lrp {} ' \
-            + ISOEXPORTDIR + ' \;')
-        # We need to copy the manifest anyway, otherwise we'll cause import issues if we have an empty repo
-        os.system('find -L /var/lib/pulp/published/http/isos/*' + repo_path \
-            + ' -name PULP_MANIFEST -exec cp --parents -Lrp {} ' + ISOEXPORTDIR + ' \;')
-
-    # At this point the iso/ export dir will contain individual repos - we need to 'normalise' them
-    if satver == '6.2':
-        for dirpath, subdirs, files in os.walk(ISOEXPORTDIR):
-            for tdir in subdirs:
-                if repo_label in tdir:
-                    # This is where the exported ISOs for our repo are located
-                    INDIR = os.path.join(dirpath, tdir)
-                    # And this is where we want them to be moved to so we can export them in Satellite format
-                    # We need to knock off '<org_name>/Library/' from beginning of repo_relative and replace with export/
-                    exportpath = "/".join(repo_relative.strip("/").split('/')[2:])
-                    OUTDIR = helpers.EXPORTDIR + '/export/' + exportpath
-
-                    # Move the files into the final export tree
-                    if not os.path.exists(OUTDIR):
-                        shutil.move(INDIR, OUTDIR)
-
-                        os.chdir(OUTDIR)
-                        numfiles = len([f for f in os.walk(".").next()[2] if f[ -8: ] != "MANIFEST"])
-
-                        msg = "File Export OK (" + str(numfiles) + " new files)"
-                        helpers.log_msg(msg, 'INFO')
-                        print helpers.GREEN + msg + helpers.ENDC
+    # Satellite 6.2 publishes under a directory ending in the repo label, 6.3 under the relative path
+    srcdirs = sorted(glob('/var/lib/pulp/published/http/isos/*' + repo_path))
+    if not srcdirs:
+        msg = "No published content found for " + repo_label + " (Satellite " + satver + ")"
+        helpers.log_msg(msg, 'WARNING')
+        return numfiles
 
-    else:
-        # Satellite 6.3 changed the published file structure
-        for dirpath, subdirs, files in os.walk(ISOEXPORTDIR):
-            if repo_relative in dirpath:
-                INDIR = dirpath
-                exportpath = "/".join(repo_relative.strip("/").split('/')[2:])
-                OUTDIR = helpers.EXPORTDIR + '/export/' + exportpath
+    # We need to knock off '<org_name>/Library/' from beginning of repo_relative and replace with export/
+    exportpath = "/".join(repo_relative.strip("/").split('/')[2:])
+    OUTDIR = helpers.EXPORTDIR + '/export/' + exportpath
 
-                # Move the files into the final export tree
-                if not os.path.exists(OUTDIR):
-                    shutil.move(INDIR, OUTDIR)
+    # Incremental exports take files changed since midnight on the last export day
+    if export_type == 'full':
+        since = None
+    else:
+        since = time.mktime(time.strptime(last_export.split(' ')[0], '%Y-%m-%d'))
 
-                    os.chdir(OUTDIR)
-                    numfiles = len([f for f in os.walk(".").next()[2] if f[ -8: ] != "MANIFEST"])
+    # We need to copy the manifest anyway, otherwise we'll cause import issues if we have an empty repo
+    if not os.path.exists(OUTDIR):
+        copied = copy_files_since(srcdirs[0], OUTDIR, since, ['PULP_MANIFEST'])
+        numfiles = len([f for f in copied if os.sep not in f and f[ -8: ] != "MANIFEST"])
 
-                    msg = "File Export OK (" + str(numfiles) + " new files)"
-                    helpers.log_msg(msg, 'INFO')
-                    print helpers.GREEN + msg + helpers.ENDC
+        msg = "File Export OK (" + str(numfiles) + " new files)"
+        helpers.log_msg(msg, 'INFO')
+        print helpers.GREEN + msg + helpers.ENDC
 
     return numfiles
 
@@ -356,56 +381,28 @@ def check_running_tasks(label, name):
     Exits script if any Synchronize or Export tasks are found in a running state.
     """
     #pylint: disable-msg=R0912,R0914,R0915
-    tasks = helpers.get_p_json(
-        helpers.FOREMAN_API + "tasks/", \
-                json.dumps(
-                    {
-                        "per_page": "100",
-                    }
-                ))
-
-    # From the list of tasks, look for any running export or sync jobs.
+    snapshot = helpers.get_task_snapshot()
+
+    # From the active tasks on this repo, look for any running export or sync jobs.
     # If e have any we exit, as we can't export in this state.
     ok_to_export = True
-    for task_result in tasks['results']:
-        if task_result['state'] == 'running':
-            if task_result['humanized']['action'] == 'Export':
-                if task_result['input']['repository']['label'] == label:
-                    msg = "Unable to export due to export task in progress"
-                    if name == 'DoV':
-                        helpers.log_msg(msg, 'ERROR')
-                        sys.exit(1)
-                    else:
-                        helpers.log_msg(msg, 'WARNING')
-                        ok_to_export = False
-            if task_result['humanized']['action'] == 'Synchronize':
-                if task_result['input']['repository']['label'] == label:
-                    msg = "Unable to export due to sync task in progress"
-                    if name == 'DoV':
-                        helpers.log_msg(msg, 'ERROR')
-                        sys.exit(1)
-                    else:
-                        helpers.log_msg(msg, 'WARNING')
-                        ok_to_export = False
-        if task_result['state'] == 'paused':
-            if task_result['humanized']['action'] == 'Export':
-                if task_result['input']['repository']['label'] == label:
-                    msg = "Unable to export due to paused export task - Please resolve this issue."
-                    if name == 'DoV':
-                        helpers.log_msg(msg, 'ERROR')
-                        sys.exit(1)
-                    else:
-                        helpers.log_msg(msg, 'WARNING')
-                        ok_to_export = False
-            if task_result['humanized']['action'] == 'Synchronize':
-                if task_result['input']['repository']['label'] == label:
-                    msg = "Unable to export due to paused sync task."
-                    if name == 'DoV':
-                        helpers.log_msg(msg, 'ERROR')
-                        sys.exit(1)
-                    else:
-                        helpers.log_msg(msg, 'WARNING')
-                        ok_to_export = False
+    for state, action in snapshot['repo'].get(label, []):
+        if state == 'running' and action == 'Export':
+            msg = "Unable to export due to export task in progress"
+        elif state == 'running' and action == 'Synchronize':
+            msg = "Unable to export due to sync task in progress"
+        elif state == 'paused' and action == 'Export':
+            msg = "Unable to export due to paused export task - Please resolve this issue."
+        elif state == 'paused' and action == 'Synchronize':
+            msg = "Unable to export due to paused sync task."
+        else:
+            continue
+        if name == 'DoV':
+            helpers.log_msg(msg, 'ERROR')
+            sys.exit(1)
+        else:
+            helpers.log_msg(msg, 'WARNING')
+            ok_to_export = False
 
     check_incomplete_sync()
     return ok_to_export
@@ -416,26 +413,38 @@ def check_incomplete_sync():
 
     These are not paused or locked, but are the orange 100% complete ones in the UI
     """
-    repo_list = helpers.get_json(
+    # Only check once per run - the result will not change between repos
+    global incomplete_checked
+    if incomplete_checked:
+        return
+    incomplete_checked = True
+
+    repo_list = helpers.get_paged(
         helpers.KATELLO_API + "/content_view_versions")
 
-    # Extract the list of repo ids, then check the state of each one.
-    incomplete_sync = False
-    for repo in repo_list['results']:
+    # Extract the de-duplicated list of repo ids, then check the state of each one.
+    repo_ids = set()
+    version_ids = set()
+    for repo in repo_list:
+        version_ids.add(repo['id'])
         for repo_id in repo['repositories']:
-            repo_status = helpers.get_json(
-                helpers.KATELLO_API + "/repositories/" + str(repo_id['id']))
-
-            if repo_status['content_type'] == 'yum':
-                if repo_status['last_sync'] is None:
-                    if repo_status['url'] is None:
-                        msg = "Repo ID " + str(repo_id['id']) + " No Sync Configured"
-                        #helpers.log_msg(msg, 'DEBUG')
-                elif repo_status['last_sync']['state'] == 'stopped':
-                    if repo_status['last_sync']['result'] == 'warning':
-                        incomplete_sync = True
-                        msg = "Repo ID " + str(repo_id['id']) + " Sync Incomplete"
-                        helpers.log_msg(msg, 'DEBUG')
+            repo_ids.add(repo_id['id'])
+    repos = helpers.get_repositories(repo_ids, version_ids)
+
+    incomplete_sync = False
+    for repo_id in sorted(repo_ids):
+        repo_status = repos[repo_id]
+
+        if repo_status['content_type'] == 'yum':
+            if repo_status['last_sync'] is None:
+                if repo_status['url'] is None:
+                    msg = "Repo ID " + str(repo_id) + " No Sync Configured"
+                    #helpers.log_msg(msg, 'DEBUG')
+            elif repo_status['last_sync']['state'] == 'stopped':
+                if repo_status['last_sync']['result'] == 'warning':
+                    incomplete_sync = True
+                    msg = "Repo ID " + str(repo_id) + " Sync Incomplete"
+                    helpers.log_msg(msg, 'DEBUG')
 
     # If we have detected incomplete sync tasks, ask the user if they want to export anyway.
     # This isn't fatal, but *MAY* lead to inconsistent repositories on the dieconnected sat.
@@ -481,6 +490,174 @@ def check_disk_space(export_type,unattended):
             sys.exit(3)
 
 
+def content_units(repo_result):
+    """Return the number of packages, files or puppet modules in a repo."""
+    counts = repo_result.get('content_counts') or {}
+    return counts.get('rpm', 0) + counts.get('file', 0) + counts.get('puppet_module', 0)
+
+
+def plan_export(repolist, labels, ename, export_type, export_times):
+    """Estimate the size of an export before any content is exported.
+
+    The content units added to each repo since its last export (all of them for a
+    full export) are costed at the bytes per unit seen in earlier exports of the
+    repo, or the average of all repos in the export set if it has no history.
+    Returns the estimate in bytes, whether it is based on measured sizes (every
+    repo with content to export has its own export history), and the plan of each
+    repo as a dict of label to {'units', 'added'} so the actual export size can be
+    recorded against it.
+    """
+    history = state.get_export_sizes(ename)
+    rates = [unit_size for units, unit_size in history.values() if unit_size]
+    if rates:
+        default_size = sum(rates) / len(rates)
+    else:
+        default_size = DEFAULT_UNIT_SIZE
+
+    estimate = 0
+    measured = True
+    plan = {}
+    for repo_result in repolist:
+        label = repo_result['label']
+        if label not in labels:
+            continue
+        units = content_units(repo_result)
+        added = units
+        if export_type == 'incr' and label in history and \
+                (label in export_times or ename in export_times):
+            added = max(units - history[label][0], 0)
+        unit_size = history.get(label, (0, 0))[1]
+        if added and not unit_size:
+            unit_size = default_size
+            measured = False
+        plan[label] = {'units': units, 'added': added}
+        estimate = estimate + added * unit_size + REPODATA_SIZE
+    return estimate, measured, plan
+
+
+def check_capacity(estimate, measured, splitsize, notar, unattended):
+    """Check that EXPORTDIR can hold the export through each of its stages.
+
+    Pulp exports the content into EXPORTDIR, the merge into a single tree renames
+    it in place, and the TAR chunks are then written alongside the tree (or the tree
+    is copied to cdn_export with --notar). If there is only room for the tree plus
+    a chunk, the TAR is written in streaming mode, removing each file from the tree
+    once it has been archived. Returns True if streaming mode is needed.
+
+    An estimate that is not based on measured export sizes (such as the first
+    export after an upgrade) only gives a warning, and the export goes ahead
+    as normal.
+    """
+    spool = int(estimate * CAPACITY_MARGIN)
+    free = helpers.disk_free(helpers.EXPORTDIR)
+    msg = "Export size estimate: Pulp export " + str(spool / 1048576) + " MB, merged tree 0 MB, " \
+        + "archive " + str(spool / 1048576) + " MB - peak " + str(2 * spool / 1048576) \
+        + " MB, " + str(free / 1048576) + " MB free in " + helpers.EXPORTDIR
+    helpers.log_msg(msg, 'INFO')
+
+    if free >= 2 * spool:
+        return False
+    if not measured:
+        msg = "Export may need more than the " + str(free / 1048576) + " MB free in " \
+            + helpers.EXPORTDIR + " - the estimate has no export history to go on, continuing"
+        helpers.log_msg(msg, 'WARNING')
+        return False
+    if not notar and free >= spool + splitsize * 1048576:
+        msg = "Insufficient space in " + helpers.EXPORTDIR + " to hold the export tree and archive " \
+            "together - the archive will be written in streaming mode"
+        helpers.log_msg(msg, 'WARNING')
+        return True
+
+    msg = "Insufficient space in " + helpers.EXPORTDIR + " for the export. " \
+        + str(2 * spool / 1048576) + " MB is estimated to be required."
+    helpers.log_msg(msg, 'WARNING')
+    if not unattended:
+        answer = helpers.query_yes_no("Continue with export?", "no")
+        if not answer:
+            msg = "Export Aborted"
+            helpers.log_msg(msg, 'ERROR')
+            sys.exit(3)
+        else:
+            msg = "Export continued by user"
+            helpers.log_msg(msg, 'INFO')
+    else:
+        msg = "Export Aborted"
+        helpers.log_msg(msg, 'ERROR')
+        sys.exit(3)
+    return not notar
+
+
+def measure_export(inventory, repo_paths, plan, ename):
+    """Work out the bytes exported per content unit of each planned repo.
+
+    Repodata is left out, as it is allowed for separately. Repos with no content
+    added keep the figure from their previous export. Returns a dict of label to
+    (units, unit_size) for the state store, to plan the next export with.
+    """
+    prefixes = repo_prefixes(repo_paths)
+    exported = {}
+    for entry in inventory:
+        if entry[1] == 'dir' or '/repodata/' in entry[0]:
+            continue
+        owner = repo_owner(entry[0], prefixes)
+        if owner:
+            exported[owner] = exported.get(owner, 0) + entry[2]
+
+    history = state.get_export_sizes(ename)
+    sizes = {}
+    for label, repo_plan in plan.iteritems():
+        unit_size = history.get(label, (0, 0))[1]
+        if repo_plan['added'] and exported.get(label):
+            unit_size = exported[label] / repo_plan['added']
+        sizes[label] = (repo_plan['units'], unit_size)
+    return sizes
+
+
+def list_entries(directory):
+    """Return (name, type, size) for each entry in a directory, sorted by name.
+
+    The type is one of 'dir', 'link', 'rpm', 'drpm' or 'file'.
+    """
+    entries = []
+    if scandir is not None:
+        dir_entries = [(entry.name, entry.stat(follow_symlinks=False)) for entry in scandir(directory)]
+    else:
+        dir_entries = [(name, os.lstat(os.path.join(directory, name))) for name in os.listdir(directory)]
+    for name, st in sorted(dir_entries):
+        if stat.S_ISDIR(st.st_mode):
+            ftype = 'dir'
+        elif stat.S_ISLNK(st.st_mode):
+            ftype = 'link'
+        elif name.endswith('.rpm'):
+            ftype = 'rpm'
+        elif name.endswith('.drpm'):
+            ftype = 'drpm'
+        else:
+            ftype = 'file'
+        entries.append((name, ftype, st.st_size))
+    return entries
+
+
+def build_inventory(topdir):
+    """Return an inventory of every file and directory under topdir.
+
+    The inventory is a list of (relpath, type, size) tuples built in a single
+    walk of the tree. Each directory is listed before its contents.
+    """
+    inventory = []
+    pending = ['']
+    while pending:
+        reldir = pending.pop()
+        subdirs = []
+        for name, ftype, size in list_entries(os.path.join(topdir, reldir)):
+            relpath = os.path.join(reldir, name)
+            inventory.append((relpath, ftype, size))
+            if ftype == 'dir':
+                subdirs.append(relpath)
+        pending.extend(reversed(subdirs))
+    return inventory
+
+
 def locate(pattern, root=os.curdir):
     """Provide simple 'locate' functionality for file search."""
     # pylint: disable=unused-variable
@@ -489,8 +666,29 @@ def locate(pattern, root=os.curdir):
             yield os.path.join(path, filename)
 
 
-def do_gpg_check(export_dir):
-    """Find and GPG Check all RPM files."""
+def gpg_check_batch(rpms):
+    """Run 'rpm -K' over a batch of RPM files and return those that fail.
+
+    The whole batch is checked with one rpm call. Only if that reports a
+    failure is each file in the batch re-checked to identify the bad ones.
+    """
+    devnull = open(os.devnull, 'wb')
+    return_code = subprocess.call(['rpm', '-K'] + rpms, stdout=devnull, stderr=devnull)
+    badrpms = []
+    # A non-zero return code indicates a GPG check failure.
+    if return_code != 0:
+        for rpm in rpms:
+            if subprocess.call(['rpm', '-K', rpm], stdout=devnull, stderr=devnull) != 0:
+                badrpms.append(rpm)
+    devnull.close()
+    return badrpms
+
+
+def do_gpg_check(export_dir, inventory):
+    """GPG Check all RPM files listed in the export inventory.
+
+    The RPMs are checked in batches, spread over all available cores.
+    """
     msg = "Checking GPG integrity of exported RPMs..."
     helpers.log_msg(msg, 'INFO')
     output = "{:<70}".format(msg)
@@ -498,16 +696,32 @@ def do_gpg_check(export_dir):
     # Force the status message to be shown to the user
     sys.stdout.flush()
 
-    badrpms = []
+    start = time.time()
     os.chdir(export_dir)
-    for rpm in locate("*.rpm"):
-        return_code = subprocess.call("rpm -K " + rpm, shell=True, stdout=open(os.devnull, 'wb'))
+    rpms = [os.path.join(export_dir, entry[0]) for entry in inventory if entry[1] == 'rpm']
+    totalsize = sum([entry[2] for entry in inventory if entry[1] == 'rpm'])
+    batches = [rpms[i:i+GPGBATCH] for i in range(0, len(rpms), GPGBATCH)]
 
-        # A non-zero return code indicates a GPG check failure.
-        if return_code != 0:
-            # For display purposes, strip the first 6 directory elements
-            rpmnew = os.path.join(*(rpm.split(os.path.sep)[6:]))
-            badrpms.append(rpmnew)
+    badrpms = []
+    if batches:
+        pool = multiprocessing.Pool(min(multiprocessing.cpu_count(), len(batches)))
+        try:
+            for result in pool.imap_unordered(gpg_check_batch, batches):
+                for rpm in result:
+                    # For display purposes, strip the first 6 directory elements
+                    rpmnew = os.path.join(*(rpm.split(os.path.sep)[6:]))
+                    badrpms.append(rpmnew)
+        finally:
+            pool.close()
+            pool.join()
+    badrpms.sort()
+
+    # Log the throughput of the check
+    elapsed = max(time.time() - start, 0.001)
+    msg = "GPG checked " + str(len(rpms)) + " RPMs (" + str(totalsize / 1048576) + " MB) in " \
+        + str(round(elapsed, 1)) + "s - " + str(round(len(rpms) / elapsed, 1)) + " RPMs/s, " \
+        + str(round(totalsize / 1048576.0 / elapsed, 1)) + " MB/s"
+    helpers.log_msg(msg, 'INFO')
 
     # If we have any bad ones we need to fail the export.
     if len(badrpms) != 0:
@@ -532,34 +746,149 @@ def do_gpg_check(export_dir):
         print helpers.GREEN + "GPG Check - Pass" + helpers.ENDC
 
 
-def create_tar(export_dir, name, export_history, splitsize):
+def split_suffix(index):
+    """Return the numeric suffix 'split -d' would give to chunk number 'index'.
+
+    Suffixes run 00-89, then 9000-9899, 990000-998999 and so on, so that the
+    chunks always sort in order when globbed.
+    """
+    level = 0
+    while index >= 9 * 10 ** (level + 1):
+        index = index - 9 * 10 ** (level + 1)
+        level = level + 1
+    return '9' * level + str(index).zfill(level + 2)
+
+
+class SplitTarWriter(object):
+    """Write a stream as a set of fixed size chunk files.
+
+    Chunks are named <basename>_00, <basename>_01 ... as per 'split -d', and the
+    sha256sum of each chunk is calculated as it is written. When the stream is
+    closed a <basename>.sha256 file is written in 'sha256sum' format.
+    """
+
+    def __init__(self, basename, splitsize):
+        self.basename = basename
+        self.chunksize = splitsize * 1024 * 1024
+        self.checksums = []
+        self.f_handle = None
+        self.shasum = None
+        self.chunkname = None
+        self.written = 0
+
+    def __open_chunk(self):
+        self.chunkname = self.basename + '_' + split_suffix(len(self.checksums))
+        self.f_handle = open(self.chunkname, 'wb')
+        self.shasum = sha256()
+        self.written = 0
+
+    def __close_chunk(self):
+        self.f_handle.close()
+        self.checksums.append((self.shasum.hexdigest(), os.path.basename(self.chunkname)))
+        self.f_handle = None
+
+    def write(self, data):
+        """Write data to the current chunk, starting new chunks as each fills."""
+        while data:
+            if self.f_handle is None:
+                self.__open_chunk()
+            part = data[:self.chunksize - self.written]
+            self.f_handle.write(part)
+            self.shasum.update(part)
+            self.written = self.written + len(part)
+            data = data[len(part):]
+            if self.written == self.chunksize:
+                self.__close_chunk()
+
+    def close(self):
+        """Close the final chunk and write the checksum file."""
+        if self.f_handle is not None:
+            self.__close_chunk()
+        f_handle = open(self.basename + '.sha256', 'w')
+        for shasum, chunkname in self.checksums:
+            f_handle.write(shasum + '  ' + chunkname + '\n')
+        f_handle.close()
+
+
+class HashingReader(object):
+    """Read a file, calculating its sha256sum as it is read."""
+
+    def __init__(self, f_handle):
+        self.f_handle = f_handle
+        self.shasum = sha256()
+
+    def read(self, size=-1):
+        """Return up to 'size' bytes from the file."""
+        data = self.f_handle.read(size)
+        self.shasum.update(data)
+        return data
+
+    def hexdigest(self):
+        """Return the sha256sum of the data read so far."""
+        return self.shasum.hexdigest()
+
+
+def create_tar(export_dir, inventory, name, fname, export_history, splitsize, checksums,
+        consume=False):
     """Create a TAR of the content we have exported.
 
-    Creates a single tar, then splits into DVD size chunks and calculates
-    sha256sum for each chunk.
+    The tar members and the RPM log are taken from the export inventory. The tar
+    is streamed directly into DVD size chunks, with the sha256sum of each chunk
+    calculated as it is written. 'fname' (YYYYMMDD-HHMM_NAME) names the dataset,
+    and is added to the export history once the TAR has been written.
+
+    'checksums' maps the path of each file to its sha256sum. Files not already in
+    it are checksummed as they are added to the TAR. Returns the list of
+    (sha256sum, chunkname) entries of the TAR chunks, and the inventory of the
+    TAR including the export history.
+
+    In streaming mode ('consume') each file is removed from the export tree once
+    it has been added, so the tree and the TAR never both need to fit on disk.
     """
-    today = datetime.datetime.strftime(datetime.datetime.now(), '%Y%m%d-%H%M')
     msg = "Creating TAR files..."
     helpers.log_msg(msg, 'INFO')
     print msg
 
-    # Add this export to the export_history list
-    fname = today + '_' + name
+    # Add this export to the export_history list shipped with the export
     export_history.append(fname)
-    pickle.dump(export_history, open(vardir + '/exporthistory_' + name + '.pkl', 'wb'))
     pickle.dump(export_history, open(export_dir + '/exporthistory_' + name + '.pkl', 'wb'))
+    inventory = inventory + [('exporthistory_' + name + '.pkl', 'file',
+        os.path.getsize(export_dir + '/exporthistory_' + name + '.pkl'))]
 
     os.chdir(export_dir)
     print "export_dir is " + export_dir
-    full_tarfile = helpers.EXPORTDIR + '/sat6_export_' + today + '_' + name
-    short_tarfile = 'sat6_export_' + today + '_' + name
-    with tarfile.open(full_tarfile, 'w') as archive:
-        archive.add(os.curdir, recursive=True)
+    full_tarfile = helpers.EXPORTDIR + '/sat6_export_' + fname
+
+    # Stream the tar into split chunks, calculating checksums on the way through
+    splitter = SplitTarWriter(full_tarfile, splitsize)
+    with tarfile.open(fileobj=splitter, mode='w|') as archive:
+        archive.add(os.curdir, recursive=False)
+        for entry in inventory:
+            tarinfo = archive.gettarinfo(os.path.join(os.curdir, entry[0]))
+            # Files hardlinked into the tree are stored in full, so each member can be
+            # extracted on its own (e.g. by a selective import)
+            if tarinfo.islnk():
+                tarinfo.type = tarfile.REGTYPE
+                tarinfo.linkname = ''
+                tarinfo.size = entry[2]
+            if not tarinfo.isreg():
+                archive.addfile(tarinfo)
+                continue
+            with open(entry[0], 'rb') as f_handle:
+                if entry[0] in checksums:
+                    archive.addfile(tarinfo, f_handle)
+                else:
+                    reader = HashingReader(f_handle)
+                    archive.addfile(tarinfo, reader)
+                    checksums[entry[0]] = reader.hexdigest()
+            if consume:
+                os.remove(entry[0])
+    splitter.close()
 
     # Get a list of all the RPM content we are exporting
-    result = [y for x in os.walk(export_dir) for y in glob(os.path.join(x[0], '*.rpm'))]
+    result = [os.path.join(export_dir, entry[0]) for entry in inventory if entry[1] == 'rpm']
     if result:
-        f_handle = open(helpers.LOGDIR + '/export_' + today + '_' + name + '.log', 'a+')
+        f_handle = open(helpers.LOGDIR + '/export_' + fname + '.log', 'a+')
         f_handle.write('-------------------\n')
         for rpm in result:
             m_rpm = os.path.join(*(rpm.split(os.path.sep)[6:]))
@@ -574,54 +903,155 @@ def create_tar(export_dir, name, export_history, splitsize):
     if os.path.exists(helpers.EXPORTDIR + "/puppet"):
         shutil.rmtree(helpers.EXPORTDIR + "/puppet")
 
-    # Split the resulting tar into DVD size chunks & remove the original.
-    msg = "Splitting TAR file..."
+    msg = "Wrote " + str(len(splitter.checksums)) + " TAR chunks and checksums"
     helpers.log_msg(msg, 'INFO')
     print msg
-    os.system("split -d -b " + str(splitsize) + "M " + full_tarfile + " " + full_tarfile + "_")
-    os.remove(full_tarfile)
 
-    # Temporary until pythonic method is done
-    msg = "Calculating Checksums..."
+    state.add_export_history(name, fname)
+    return splitter.checksums, inventory
+
+
+def get_repo_paths(repolist, labels):
+    """Return the path of each repo within the export tree, keyed by repo label.
+
+    The '<org_name>/Library/' prefix of the repo relative_path is dropped, as it is
+    when the export tree is merged.
+    """
+    repo_paths = {}
+    for repo_result in repolist:
+        if repo_result['label'] in labels:
+            repo_paths[repo_result['label']] = \
+                "/".join(repo_result['relative_path'].strip("/").split('/')[2:])
+    return repo_paths
+
+
+def repo_prefixes(repo_paths):
+    """Return the (label, path) of each repo with a path, longest path first."""
+    return sorted([(label, path) for label, path in repo_paths.iteritems() if path],
+        key=lambda item: len(item[1]), reverse=True)
+
+
+def repo_owner(relpath, prefixes):
+    """Return the label of the repo a path in the export tree belongs to, or None."""
+    for label, path in prefixes:
+        if relpath.startswith(path + '/'):
+            return label
+    return None
+
+
+def write_manifest(fname, name, export_type, inventory, checksums, chunks, repo_paths,
+        exported_repos, package_count, skipped):
+    """Write the bundle manifest beside the .sha256 file of the export.
+
+    The manifest is a JSON document describing the dataset without having to
+    extract it: the TAR chunks with their sizes and checksums, each repo with its
+    path, package count and content size, every file in the export with its
+    size, sha256sum and owning repo, and the files left out of the export as
+    they were already shipped.
+    """
+    prefixes = repo_prefixes(repo_paths)
+    repos = {}
+    for label in set(repo_paths.keys()) | set(exported_repos) | set(package_count.keys()):
+        repos[label] = {'path': repo_paths.get(label), 'packages': package_count.get(label),
+            'sync': label in exported_repos, 'files': 0, 'size': 0}
+
+    files = []
+    for entry in inventory:
+        if entry[1] == 'dir':
+            continue
+        owner = repo_owner(entry[0], prefixes)
+        if owner:
+            repos[owner]['files'] = repos[owner]['files'] + 1
+            repos[owner]['size'] = repos[owner]['size'] + entry[2]
+        files.append({'path': entry[0], 'type': entry[1], 'size': entry[2],
+            'sha256': checksums.get(entry[0]), 'repo': owner})
+
+    manifest = {
+        'version': 1,
+        'dataset': fname,
+        'name': name,
+        'export_type': export_type,
+        'created': datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S'),
+        'chunks': [{'name': chunkname, 'sha256': shasum,
+            'size': os.path.getsize(helpers.EXPORTDIR + '/' + chunkname)}
+            for shasum, chunkname in chunks],
+        'size': sum([entry[2] for entry in inventory if entry[1] != 'dir']),
+        'repos': repos,
+        'files': files,
+        'skipped': skipped,
+    }
+
+    manifest_file = helpers.EXPORTDIR + '/sat6_export_' + fname + '.manifest.json'
+    with open(manifest_file + '.tmp', 'w') as f_handle:
+        json.dump(manifest, f_handle, separators=(',', ':'), sort_keys=True)
+    os.rename(manifest_file + '.tmp', manifest_file)
+
+    msg = "Wrote bundle manifest " + manifest_file
     helpers.log_msg(msg, 'INFO')
-    print msg
-    os.system('sha256sum ' + short_tarfile + '_* > ' + short_tarfile + '.sha256')
+
+
+def merge_tree(srcdir, destdir):
+    """Merge the contents of srcdir into destdir, consuming srcdir.
+
+    Directories that do not yet exist in destdir are moved across with a single
+    rename. Files are renamed into place, and only copied if srcdir is on a
+    different filesystem. Entries are processed in sorted order, and where a file
+    already exists in destdir the incoming file replaces it, so the last merged
+    export always wins.
+    """
+    for name in sorted(os.listdir(srcdir)):
+        src = os.path.join(srcdir, name)
+        dest = os.path.join(destdir, name)
+        if os.path.isdir(src) and not os.path.islink(src):
+            if os.path.lexists(dest) and not os.path.isdir(dest):
+                msg = "Replacing " + dest + " with directory from " + srcdir
+                helpers.log_msg(msg, 'DEBUG')
+                os.remove(dest)
+            if os.path.isdir(dest):
+                merge_tree(src, dest)
+                continue
+        elif os.path.lexists(dest):
+            # Listing files collide all the time, they are regenerated after the merge
+            if name != 'listing':
+                msg = "Replacing " + dest + " with file from " + srcdir
+                helpers.log_msg(msg, 'DEBUG')
+            if os.path.isdir(dest) and not os.path.islink(dest):
+                shutil.rmtree(dest)
+            else:
+                os.remove(dest)
+
+        try:
+            os.rename(src, dest)
+        except OSError:
+            # Different filesystem - fall back to a copy
+            if os.path.isdir(src) and not os.path.islink(src):
+                shutil.copytree(src, dest, symlinks=True)
+            else:
+                shutil.copy2(src, dest)
 
 
 def prep_export_tree(org_label, basepaths):
     """Combine individual export directories into single export tree.
 
-    Export top level contains /content and /custom directories with 'listing'
-    files through the tree.
+    Export top level contains /content and /custom directories. The 'listing'
+    files through the tree are rebuilt from its inventory by create_listing_files.
     """
     msg = "Preparing export directory tree..."
     helpers.log_msg(msg, 'INFO')
     print msg
-    devnull = open(os.devnull, 'wb')
     if not os.path.exists(helpers.EXPORTDIR + "/export"):
         os.makedirs(helpers.EXPORTDIR + "/export")
 
-    # Copy the content from each exported repo into a common /export structure
+    # Move the content from each exported repo into a common /export structure
     for basepath in basepaths:
         msg = "Processing " + basepath
         helpers.log_msg(msg, 'DEBUG')
-        subprocess.call("cp -rp " + basepath + "*/" + org_label + \
-            "/Library/* " + helpers.EXPORTDIR + "/export", shell=True, stdout=devnull, stderr=devnull)
+        for srcdir in sorted(glob(basepath + "*/" + org_label + "/Library")):
+            merge_tree(srcdir, helpers.EXPORTDIR + "/export")
 
         # Remove original directories
-        os.system("rm -rf " + basepath + "*/")
-
-    # We need to re-generate the 'listing' files as we will have overwritten some during the merge
-    msg = "Rebuilding listing files..."
-    helpers.log_msg(msg, 'INFO')
-    print msg
-    create_listing_file(helpers.EXPORTDIR + "/export")
-
-    # s: disable=unused-variable
-    for root, directories, filenames in os.walk(helpers.EXPORTDIR + "/export"):
-        for subdir in directories:
-            currentdir = os.path.join(root, subdir)
-            create_listing_file(currentdir)
+        for srcdir in glob(basepath + "*/"):
+            shutil.rmtree(srcdir)
 
 
 def get_immediate_subdirectories(a_dir):
@@ -629,45 +1059,230 @@ def get_immediate_subdirectories(a_dir):
     return [name for name in os.listdir(a_dir) if os.path.isdir(os.path.join(a_dir, name))]
 
 
-def create_listing_file(directory):
-    """Create the listing file containing the subdirectories."""
+def create_listing_file(directory, subdirs=None):
+    """Create the listing file containing the subdirectories.
+
+    If the list of subdirectories is already known it can be passed in 'subdirs'.
+    """
+    if subdirs is None:
+        subdirs = get_immediate_subdirectories(directory)
+    # Never write through a hardlink back into the published content
+    if os.path.lexists(directory + "/listing"):
+        os.remove(directory + "/listing")
     listing_file = open(directory + "/listing", "w")
-    sorted_subdirs = sorted(get_immediate_subdirectories(directory))
+    sorted_subdirs = sorted(subdirs)
     for directory in sorted_subdirs:
         listing_file.write(directory + "\n")
     listing_file.close()
 
 
-def read_pickle(name):
-    """Read the last export dates from an existing pickle."""
-    if not os.path.exists(vardir + '/exports_' + name + '.pkl'):
-        if not os.path.exists(vardir):
-            os.makedirs(vardir)
-        export_times = {}
-        return export_times
+def create_listing_files(topdir, inventory):
+    """Create the listing files for every directory in the tree from its inventory.
+
+    Returns the inventory with an entry for each listing file, placed straight
+    after the directory it belongs to.
+    """
+    subdirs = {'': []}
+    for relpath, ftype, size in inventory:
+        if ftype == 'dir':
+            subdirs[relpath] = []
+        if ftype == 'dir' or (ftype == 'link' and os.path.isdir(os.path.join(topdir, relpath))):
+            subdirs.setdefault(os.path.dirname(relpath), []).append(os.path.basename(relpath))
+
+    listings = {}
+    for reldir, names in subdirs.iteritems():
+        create_listing_file(os.path.join(topdir, reldir), names)
+        relpath = os.path.join(reldir, 'listing')
+        listings[reldir] = (relpath, 'file', os.path.getsize(os.path.join(topdir, relpath)))
+
+    updated = [listings['']]
+    for entry in inventory:
+        if entry[1] != 'dir' and os.path.basename(entry[0]) == 'listing':
+            continue
+        updated.append(entry)
+        if entry[0] in listings:
+            updated.append(listings[entry[0]])
+    return updated
+
+
+def shippable(entry):
+    """Return True if an inventory entry is an rpm, drpm or iso tracked in the shipped index."""
+    return entry[1] in ('rpm', 'drpm') or (entry[1] == 'file' and entry[0].endswith('.iso'))
+
+
+def dedup_export(export_dir, inventory, shipped):
+    """Remove exported packages that have already been shipped to the disconnected side.
+
+    Only the rpm/drpm/iso files whose path is in the 'shipped' index are read, and
+    those with a matching checksum are removed from the export. Returns the updated
+    inventory, the checksums taken of the files that are being shipped (so they are
+    not read again while writing the TAR) and the list of paths that were skipped.
+    """
+    msg = "Checking exported files against previously shipped content..."
+    helpers.log_msg(msg, 'INFO')
+    print msg
+
+    checksums = {}
+    skipped = []
+    shipping = []
+    for entry in inventory:
+        relpath = entry[0]
+        if shippable(entry) and relpath in shipped:
+            fname = os.path.join(export_dir, relpath)
+            shasum = helpers.sha256sum(fname)[0]
+            if shipped[relpath] == shasum:
+                os.remove(fname)
+                skipped.append(relpath)
+                continue
+            checksums[relpath] = shasum
+        shipping.append(entry)
+    skipped.sort()
+
+    msg = "Skipped " + str(len(skipped)) + " previously shipped files, shipping " \
+        + str(len([entry for entry in shipping if shippable(entry)])) + " files"
+    helpers.log_msg(msg, 'INFO')
+    print msg
+
+    return shipping, checksums, skipped
+
+
+def shipped_files(export_dir, inventory, checksums):
+    """Return the sha256sum of each rpm/drpm/iso in the export, keyed by path.
+
+    These are the entries added to the shipped index. Checksums already taken by the
+    dedup check or while writing the TAR are used, and only files without one
+    (an export with --notar) are read here.
+    """
+    files = {}
+    for entry in inventory:
+        if shippable(entry):
+            if entry[0] not in checksums:
+                checksums[entry[0]] = helpers.sha256sum(os.path.join(export_dir, entry[0]))[0]
+            files[entry[0]] = checksums[entry[0]]
+    return files
+
+
+def read_checkpoint(name):
+    """Read the checkpoint journal left behind by an interrupted export, if any."""
+    return state.get_checkpoint('export_' + name)
+
+
+def write_checkpoint(name, checkpoint):
+    """Write the checkpoint journal to the state store."""
+    state.put_checkpoint('export_' + name, checkpoint)
 
-    # Read in the export time pickle
-    export_times = pickle.load(open(vardir + '/exports_' + name + '.pkl', 'rb'))
-    return export_times
+
+def clear_checkpoint(name):
+    """Remove the checkpoint journal once an export has completed."""
+    state.clear_checkpoint('export_' + name)
+
+
+def set_checkpoint_stage(name, checkpoint, stage):
+    """Record that the export has completed a stage for every repo it contains."""
+    checkpoint['stage'] = stage
+    for repo in checkpoint['repos'].values():
+        repo['stage'] = stage
+    write_checkpoint(name, checkpoint)
+
+
+def stage_done(checkpoint, stage):
+    """Return True if the checkpointed export has already completed the given stage."""
+    if checkpoint['stage'] is None:
+        return False
+    return EXPORT_STAGES.index(checkpoint['stage']) >= EXPORT_STAGES.index(stage)
+
+
+def discard_partial_export(repo_relative):
+    """Remove the export tree of a file/puppet repo that an interrupted export left behind."""
+    exportpath = "/".join(repo_relative.strip("/").split('/')[2:])
+    OUTDIR = helpers.EXPORTDIR + '/export/' + exportpath
+    if os.path.exists(OUTDIR):
+        msg = "Removing partial export " + OUTDIR
+        helpers.log_msg(msg, 'DEBUG')
+        shutil.rmtree(OUTDIR)
 
 
 def get_product(org_id, cp_id):
     """Find and return the label of the given product ID."""
-    prod_list = helpers.get_p_json(
-        helpers.KATELLO_API + "/products/", \
-                json.dumps(
-                        {
-                           "organization_id": org_id,
-                           "per_page": '1000',
-                        }
-                ))
-
-    for prod in prod_list['results']:
+    for prod in helpers.get_products(org_id):
         if prod['cp_id'] == cp_id:
             prodlabel = prod['label']
             return prodlabel
 
 
+def check_repo_export(org_id, org_name, repo_result, export_type):
+    """Locate the exported content of a repo and count the exported packages.
+
+    Returns the basepath of the export and the number of rpms/drpms exported.
+    Exits the script if the export path was not created by Pulp.
+    """
+    # First resolve the product label - this forms part of the export path
+    product = get_product(org_id, repo_result['product']['cp_id'])
+
+    # Satellite 6.3 uses a new backend_identifier key in the API result
+    if 'backend_identifier' in repo_result:
+        basepath = helpers.EXPORTDIR + "/" + repo_result['backend_identifier']
+    else:
+        basepath = helpers.EXPORTDIR + "/" + org_name + "-" + product + "-" + repo_result['label']
+
+    if export_type == 'incr':
+        exportpath = basepath + "-incremental/" + repo_result['relative_path']
+    else:
+        exportpath = basepath + "/" + repo_result['relative_path']
+    msg = "\nExport path = " + exportpath
+    helpers.log_msg(msg, 'DEBUG')
+
+    if not os.path.exists(exportpath):
+        msg = exportpath + " was not created.\nCheck permissions/SELinux on export dir"
+        helpers.log_msg(msg, 'ERROR')
+        if helpers.MAILOUT:
+            helpers.tf.seek(0)
+            output = "{}".format(helpers.tf.read())
+            subject = "Satellite 6 export failure"
+            helpers.mailout(subject, output)
+        sys.exit(1)
+
+    # Count the number of .rpm files in the exported repo (recursively)
+    inventory = build_inventory(exportpath)
+    numrpms = len([entry for entry in inventory if entry[1] == 'rpm'])
+    numdrpms = len([entry for entry in inventory if entry[1] == 'drpm'])
+
+    if numdrpms == 0:
+        msg = "Repository Export OK (" + str(numrpms) + " new rpms)"
+    else:
+        msg = "Repository Export OK (" + str(numrpms) + " new rpms + " + str(numdrpms) + " drpms)"
+    helpers.log_msg(msg, 'INFO')
+    print helpers.GREEN + msg + helpers.ENDC
+
+    return basepath, numrpms
+
+
+def export_repos_parallel(jobs, parallel, ename, on_complete):
+    """Run the Pulp export of several yum repositories concurrently.
+
+    'jobs' is a list of dicts holding the repo_result, last_export and export_type
+    of each repo. Up to 'parallel' exports are kept running by helpers.run_tasks.
+    'on_complete' is called with the job and the final task info as soon as each
+    export task finishes.
+    """
+    def start(job):
+        repo_result = job['repo_result']
+
+        # Check if there are any currently running tasks that will conflict
+        ok_to_export = check_running_tasks(repo_result['label'], ename)
+        if not ok_to_export:
+            return None
+
+        job['numpkg'] = count_packages(repo_result['id'])
+        export_id = export_repo(repo_result['id'], job['last_export'], job['export_type'])
+        msg = "Export of " + repo_result['label'] + " started (task " + export_id + ")"
+        helpers.log_msg(msg, 'INFO')
+        print msg
+        return export_id, repo_result['label']
+
+    helpers.run_tasks(jobs, start, on_complete, parallel, "Export of repositories", False)
+
+
 def main(args):
     """
     Main Routine
@@ -680,9 +1295,11 @@ def main(args):
     # Set the base dir of the script and where the var data is
     global dir
     global vardir
+    global state
     dir = os.path.dirname(__file__)
     vardir = os.path.join(dir, 'var')
     confdir = os.path.join(dir, 'config')
+    state = helpers.StateStore(vardir)
 
     # Check for sane input
     parser = argparse.ArgumentParser(description='Performs Export of Default Content View.')
@@ -715,6 +1332,12 @@ def main(args):
         required=False, action="store_true")
     parser.add_argument('-S', '--splitsize', help='Size of split files in Megabytes, defaults to 4200',
         required=False, type=int, default=4200)
+    parser.add_argument('--nodedup', help='Do not skip files already shipped in earlier exports',
+        required=False, action="store_true")
+    parser.add_argument('--parallel', help='Number of repository exports to run in parallel, defaults to 1',
+        required=False, type=int, default=1)
+    parser.add_argument('--resume', help='Resume an interrupted export from its last completed stage',
+        required=False, action="store_true")
     args = parser.parse_args()
 
     # If we are set as the 'DISCONNECTED' satellite, we will generally be IMPORTING content.
@@ -745,6 +1368,7 @@ def main(args):
     exported_repos = []
     export_history = []
     basepaths = []
+    basepath_labels = {}
     package_count = {}
     # If a specific environment is requested, find and read that config file
     repocfg = os.path.join(dir, confdir + '/exports.yml')
@@ -780,13 +1404,12 @@ def main(args):
         msg = "DoV export called"
         helpers.log_msg(msg, 'DEBUG')
 
-    # Read the last export date pickle for our selected repo group.
-    export_times = read_pickle(ename)
+    # Read the last export dates for our selected repo group.
+    export_times = state.get_export_times(ename)
     export_type = 'incr'
 
-    # Open the export history pickle so we can append to it
-    if os.path.exists(vardir + '/exporthistory_' + ename + '.pkl'):
-        export_history = pickle.load(open(vardir + '/exporthistory_' + ename + '.pkl', 'rb'))
+    # Read the export history so we can append to it
+    export_history = state.get_export_history(ename)
 
     if args.all:
         print "Performing full content export for " + ename
@@ -836,6 +1459,28 @@ def main(args):
 
     # Get the current time - this will be the 'last export' time if the export is OK
     start_time = datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S')
+
+    # Pick up the checkpoint journal of an interrupted export if we are resuming.
+    # The resumed export keeps the start time and export type of the original run.
+    checkpoint = None
+    if args.resume:
+        checkpoint = read_checkpoint(ename)
+        if checkpoint:
+            start_time = checkpoint['start_time']
+            export_type = checkpoint['export_type']
+            msg = "Resuming " + ename + " export started " + start_time + " (" \
+                + str(len(checkpoint['repos'])) + " repos exported, last completed stage: " \
+                + str(checkpoint['stage']) + ")"
+        else:
+            msg = "No interrupted export found for " + ename + ", starting a new export"
+        helpers.log_msg(msg, 'INFO')
+        print msg
+    resumed = checkpoint is not None
+    if not resumed:
+        checkpoint = {'start_time': start_time, 'export_type': export_type, 'stage': None,
+            'repos': {}, 'tarname': None}
+        write_checkpoint(ename, checkpoint)
+
     print "START: " + start_time + " (" + ename + " export)"
 
 
@@ -843,7 +1488,7 @@ def main(args):
     check_disk_space(export_type,args.unattended)
 
     # Remove any previous exported content left behind by prior unclean exit
-    if os.path.exists(helpers.EXPORTDIR + '/export'):
+    if not resumed and os.path.exists(helpers.EXPORTDIR + '/export'):
         msg = "Removing existing export directory"
         helpers.log_msg(msg, 'DEBUG')
         shutil.rmtree(helpers.EXPORTDIR + '/export')
@@ -851,17 +1496,36 @@ def main(args):
     # Collect a list of enabled repositories. This is needed for:
     # 1. Matching specific repo exports, and
     # 2. Running import sync per repo on the disconnected side
-    repolist = helpers.get_p_json(
-        helpers.KATELLO_API + "/repositories/", \
-                json.dumps(
-                        {
-                           "organization_id": org_id,
-                           "per_page": '1000',
-                        }
-                ))
+    repolist = list(helpers.get_paged(
+        helpers.KATELLO_API + "/repositories/",
+        {
+            "organization_id": org_id,
+        }))
+
+    # Check there is room for the export before anything is exported
+    if not resumed:
+        if ename == 'DoV':
+            labels = [repo_result['label'] for repo_result in repolist
+                if repo_result['content_type'] == 'yum']
+        else:
+            labels = erepos
+        estimate, measured, checkpoint['plan'] = plan_export(repolist, labels, ename,
+            export_type, export_times)
+        checkpoint['streaming'] = check_capacity(estimate, measured, args.splitsize, args.notar,
+            args.unattended)
+        write_checkpoint(ename, checkpoint)
+
+    # If the DoV was exported before an interrupted run, pick it up from the checkpoint
+    if ename == 'DoV' and 'DoV' in checkpoint['repos']:
+        msg = "Export of DoV already completed, resuming"
+        helpers.log_msg(msg, 'INFO')
+        print msg
+        basepaths.append(checkpoint['repos']['DoV']['basepath'])
+        export_times['DoV'] = start_time
+        exported_repos.extend(checkpoint['repos']['DoV']['exported'])
 
     # If we are running a full DoV export we run a different set of API calls...
-    if ename == 'DoV':
+    elif ename == 'DoV':
         cola = "Exporting DoV"
         if export_type == 'incr' and 'DoV' in export_times:
             last_export = export_times['DoV']
@@ -909,11 +1573,15 @@ def main(args):
             export_times['DoV'] = start_time
 
             # Generate a list of repositories that were exported
-            for repo_result in repolist['results']:
+            for repo_result in repolist:
                 if repo_result['content_type'] == 'yum':
                     # Add the repo to the successfully exported list
                     exported_repos.append(repo_result['label'])
 
+            checkpoint['repos']['DoV'] = {'stage': 'exported', 'basepath': basepath,
+                'exported': list(exported_repos)}
+            write_checkpoint(ename, checkpoint)
+
         else:
             msg = "Content View Export FAILED"
             helpers.log_msg(msg, 'ERROR')
@@ -923,7 +1591,7 @@ def main(args):
         # Verify that defined repos exist in Satellite
         for repo in erepos:
             repo_in_sat = False
-            for repo_x in repolist['results']:
+            for repo_x in repolist:
                 if re.findall("\\b" + repo + "\\b$", repo_x['label']):
                     repo_in_sat = True
                     break
@@ -931,8 +1599,60 @@ def main(args):
                 msg = "'" + repo + "' not found in Satellite"
                 helpers.log_msg(msg, 'WARNING')
 
+        # Post-export handling of each yum repo. Used by both the serial and parallel export paths.
+        def repo_export_done(job, tinfo):
+            repo_result = job['repo_result']
+            package_count[repo_result['label']] = job['numpkg']
+            if tinfo['state'] != 'running' and tinfo['result'] == 'success':
+                basepath, numrpms = check_repo_export(org_id, org_name, repo_result,
+                    job['export_type'])
+
+                # Add to the basepath list so we can use specific paths later
+                # (Introduced due to path name changes in Sat6.3)
+                basepaths.append(basepath)
+                basepath_labels[basepath] = repo_result['label']
+
+                # Update the export timestamp for this repo
+                export_times[repo_result['label']] = start_time
+
+                # Add the repo to the successfully exported list
+                if numrpms != 0 or args.repodata:
+                    msg = "Adding " + repo_result['label'] + " to export list"
+                    helpers.log_msg(msg, 'DEBUG')
+                    exported_repos.append(repo_result['label'])
+                else:
+                    msg = "Not including repodata for empty repo " + repo_result['label']
+                    helpers.log_msg(msg, 'DEBUG')
+
+                checkpoint['repos'][repo_result['label']] = {'stage': 'exported',
+                    'basepath': basepath, 'numpkg': job['numpkg'],
+                    'include': repo_result['label'] in exported_repos}
+                write_checkpoint(ename, checkpoint)
+            else:
+                msg = "Export FAILED for " + repo_result['label']
+                helpers.log_msg(msg, 'ERROR')
+
+        # Yum repos queued for export when running in parallel mode
+        yum_jobs = []
+
         # Process each repo
-        for repo_result in repolist['results']:
+        for repo_result in repolist:
+            # Repos exported before an interrupted run are picked up from the checkpoint
+            if repo_result['label'] in erepos and repo_result['label'] in checkpoint['repos']:
+                done = checkpoint['repos'][repo_result['label']]
+                msg = "Export of " + repo_result['label'] + " already completed, resuming"
+                helpers.log_msg(msg, 'INFO')
+                print msg
+                if done['basepath']:
+                    basepaths.append(done['basepath'])
+                    basepath_labels[done['basepath']] = repo_result['label']
+                if done['numpkg'] is not None:
+                    package_count[repo_result['label']] = done['numpkg']
+                export_times[repo_result['label']] = start_time
+                if done['include']:
+                    exported_repos.append(repo_result['label'])
+                continue
+
             if repo_result['content_type'] == 'yum':
                 # If we have a match, do the export
                 if repo_result['label'] in erepos:
@@ -956,94 +1676,36 @@ def main(args):
                     output = "{:<70}".format(cola)
                     print output[:70] + ' ' + colb
 
+                    job = {'repo_result': repo_result, 'last_export': last_export,
+                        'export_type': export_type}
+
+                    # Reset the export type to the user specified, in case we overrode it.
+                    export_type = orig_export_type
+
+                    # In parallel mode the export is submitted once all repos are queued
+                    if args.parallel > 1:
+                        yum_jobs.append(job)
+                        continue
+
                     # Check if there are any currently running tasks that will conflict
                     ok_to_export = check_running_tasks(repo_result['label'], ename)
                     if ok_to_export:
                         # Count the number of packages
-                        numpkg = count_packages(repo_result['id'])
-                        package_count[repo_result['label']] = numpkg
+                        job['numpkg'] = count_packages(repo_result['id'])
 
                         # Trigger export on the repo
-                        export_id = export_repo(repo_result['id'], last_export, export_type)
+                        export_id = export_repo(repo_result['id'], last_export, job['export_type'])
 
                         # Now we need to wait for the export to complete
                         helpers.wait_for_task(export_id, 'export')
 
-                        # Check if the export completed OK. If not we exit the script.
+                        # Check if the export completed OK.
                         tinfo = helpers.get_task_status(export_id)
-                        if tinfo['state'] != 'running' and tinfo['result'] == 'success':
-                            # Count the number of exported packages
-                            # First resolve the product label - this forms part of the export path
-                            product = get_product(org_id, repo_result['product']['cp_id'])
-                            # Now we can build the export path itself
-
-                            # Satellite 6.3 uses a new backend_identifier key in the API result
-                            if 'backend_identifier' in repo_result:
-                                basepath = helpers.EXPORTDIR + "/" + repo_result['backend_identifier']
-                            else:
-                                basepath = helpers.EXPORTDIR + "/" + org_name + "-" + product + "-" + repo_result['label']
-
-                            # Add to the basepath list so we can use specific paths later
-                            # (Introduced due to path name changes in Sat6.3)
-                            basepaths.append(basepath)
-
-                            if export_type == 'incr':
-                                basepath = basepath + "-incremental"
-                            exportpath = basepath + "/" + repo_result['relative_path']
-                            msg = "\nExport path = " + exportpath
-                            helpers.log_msg(msg, 'DEBUG')
-
-                            if not os.path.exists(exportpath):
-                                msg = exportpath + " was not created.\nCheck permissions/SELinux on export dir"
-                                helpers.log_msg(msg, 'ERROR')
-                                if helpers.MAILOUT:
-                                    helpers.tf.seek(0)
-                                    output = "{}".format(helpers.tf.read())
-                                    subject = "Satellite 6 export failure"
-                                    helpers.mailout(subject, output)
-                                sys.exit(1)
-
-                            # Count the number of .rpm files in the exported repo (recursively)
-                            numrpms = 0
-                            numdrpms = 0
-                            for dirpath, dirs, files in os.walk(exportpath):
-                                for filename in files:
-                                    fname = os.path.join(dirpath,filename)
-                                    if fname.endswith('.rpm'):
-                                        numrpms = numrpms + 1
-                                    if fname.endswith('.drpm'):
-                                        numdrpms = numdrpms + 1
-
-                            if numdrpms == 0:
-                                msg = "Repository Export OK (" + str(numrpms) + " new rpms)"
-                            else:
-                                msg = "Repository Export OK (" + str(numrpms) + " new rpms + " + str(numdrpms) + " drpms)"
-                            helpers.log_msg(msg, 'INFO')
-                            print helpers.GREEN + msg + helpers.ENDC
-
-                            # Update the export timestamp for this repo
-                            export_times[repo_result['label']] = start_time
-
-                            # Add the repo to the successfully exported list
-                            if numrpms != 0 or args.repodata:
-                                msg = "Adding " + repo_result['label'] + " to export list"
-                                helpers.log_msg(msg, 'DEBUG')
-                                exported_repos.append(repo_result['label'])
-                            else:
-                                msg = "Not including repodata for empty repo " + repo_result['label']
-                                helpers.log_msg(msg, 'DEBUG')
-
-                        else:
-                            msg = "Export FAILED"
-                            helpers.log_msg(msg, 'ERROR')
-
-                        # Reset the export type to the user specified, in case we overrode it.
-                        export_type = orig_export_type
+                        repo_export_done(job, tinfo)
 
                 else:
                     msg = "Skipping  " + repo_result['label']
                     helpers.log_msg(msg, 'DEBUG')
-
             # Handle FILE type exports (ISO repos)
             elif repo_result['content_type'] == 'file':
                 # If we have a match, do the export
@@ -1071,6 +1733,9 @@ def main(args):
                     # Check if there are any currently running tasks that will conflict
                     ok_to_export = check_running_tasks(repo_result['label'], ename)
                     if ok_to_export:
+                        if resumed:
+                            discard_partial_export(repo_result['relative_path'])
+
                         # Satellite 6.3 uses a different path for published file content
                         if 'backend_identifier' in repo_result:
                             repo_path = repo_result['relative_path']
@@ -1097,6 +1762,11 @@ def main(args):
                             msg = "Not including repodata for empty repo " + repo_result['label']
                             helpers.log_msg(msg, 'DEBUG')
 
+                        checkpoint['repos'][repo_result['label']] = {'stage': 'exported',
+                            'basepath': None, 'numpkg': None,
+                            'include': repo_result['label'] in exported_repos}
+                        write_checkpoint(ename, checkpoint)
+
                 else:
                     msg = "Skipping  " + repo_result['label']
                     helpers.log_msg(msg, 'DEBUG')
@@ -1133,6 +1803,9 @@ def main(args):
                         backend_id = repo_result['label']
 
                     if ok_to_export:
+                        if resumed:
+                            discard_partial_export(repo_result['relative_path'])
+
                         # Trigger export on the repo
                         numfiles = export_puppet(repo_result['id'], backend_id, repo_result['relative_path'], last_export, export_type, pforge)
 
@@ -1151,51 +1824,132 @@ def main(args):
                             msg = "Not including repodata for empty repo " + repo_result['label']
                             helpers.log_msg(msg, 'DEBUG')
 
+                        checkpoint['repos'][repo_result['label']] = {'stage': 'exported',
+                            'basepath': None, 'numpkg': None,
+                            'include': repo_result['label'] in exported_repos}
+                        write_checkpoint(ename, checkpoint)
+
                 else:
                     msg = "Skipping  " + repo_result['label']
                     helpers.log_msg(msg, 'DEBUG')
 
+        # Run the queued yum exports concurrently
+        if yum_jobs:
+            msg = "Running up to " + str(args.parallel) + " repository exports in parallel"
+            helpers.log_msg(msg, 'INFO')
+            print msg
+            export_repos_parallel(yum_jobs, args.parallel, ename, repo_export_done)
 
     # Combine resulting directory structures into a single repo format (top level = /content)
-    prep_export_tree(org_label, basepaths)
+    if not stage_done(checkpoint, 'merged'):
+        # Merge in repolist order, not the order the (parallel) exports completed in,
+        # so that the 'last merged wins' rule gives the same tree on every run
+        repo_order = dict([(repo_result['label'], index)
+            for index, repo_result in enumerate(repolist)])
+        basepaths.sort(key=lambda basepath: repo_order.get(basepath_labels.get(basepath), -1))
+        prep_export_tree(org_label, basepaths)
+        set_checkpoint_stage(ename, checkpoint, 'merged')
 
     # Now we need to process the on-disk export data.
     # Define the location of our exported data.
     export_dir = helpers.EXPORTDIR + "/export"
 
-    # Write out the list of exported repos and the package counts. These will be transferred to the
-    # disconnected system and used to perform the repo sync tasks during the import.
-    pickle.dump(exported_repos, open(export_dir + '/exported_repos.pkl', 'wb'))
-    pickle.dump(package_count, open(export_dir + '/package_count.pkl', 'wb'))
+    if stage_done(checkpoint, 'counted'):
+        inventory = checkpoint['inventory']
+    else:
+        # Write out the list of exported repos and the package counts. These will be transferred to the
+        # disconnected system and used to perform the repo sync tasks during the import.
+        pickle.dump(exported_repos, open(export_dir + '/exported_repos.pkl', 'wb'))
+        pickle.dump(package_count, open(export_dir + '/package_count.pkl', 'wb'))
 
-    # Run GPG Checks on the exported RPMs
-    if not args.nogpg:
-        do_gpg_check(export_dir)
+        # Copy in the manifest, if it has been downloaded
+        export_manifest()
+
+        # Take an inventory of the export tree. This is used for all further processing.
+        inventory = build_inventory(export_dir)
+
+        # We need to re-generate the 'listing' files as we will have overwritten some during the merge
+        msg = "Rebuilding listing files..."
+        helpers.log_msg(msg, 'INFO')
+        print msg
+        inventory = create_listing_files(export_dir, inventory)
+
+        # Record how big each repo's export was, to plan the next export with
+        if checkpoint.get('plan'):
+            checkpoint['sizes'] = measure_export(inventory,
+                get_repo_paths(repolist, checkpoint['plan']), checkpoint['plan'], ename)
 
-    # Copy in the manifest, if it has been downloaded
-    export_manifest()
+        # Remove any files the disconnected side already has (incremental exports only)
+        checkpoint['checksums'] = {}
+        checkpoint['skipped'] = []
+        if not args.nodedup and export_type == 'incr':
+            inventory, checkpoint['checksums'], checkpoint['skipped'] = dedup_export(export_dir,
+                inventory, state.get_shipped(ename))
+
+        checkpoint['inventory'] = inventory
+        set_checkpoint_stage(ename, checkpoint, 'counted')
+
+    # Run GPG Checks on the exported RPMs
+    if not stage_done(checkpoint, 'gpgchecked'):
+        if not args.nogpg:
+            do_gpg_check(export_dir, inventory)
+        set_checkpoint_stage(ename, checkpoint, 'gpgchecked')
 
     # Add our exported data to a tarfile
-    if not args.notar:
-        create_tar(export_dir, ename, export_history, args.splitsize)
-    else:
-        # We need to manually clean up a couple of working files from the export
-        if os.path.exists(helpers.EXPORTDIR + "/iso"):
-            shutil.rmtree(helpers.EXPORTDIR + "/iso")
-        if os.path.exists(helpers.EXPORTDIR + "/puppet"):
-            shutil.rmtree(helpers.EXPORTDIR + "/puppet")
-        os.system("rm -f " + helpers.EXPORTDIR + "/*.pkl")
-        os.system("rm -f " + export_dir + "/*.pkl")
-
-        # Copy export_dir to cdn_export to prevent blowing it away next time we export
-        copy_tree(export_dir,helpers.EXPORTDIR + "/cdn_export")
-        # Cleanup
-        shutil.rmtree(helpers.EXPORTDIR + "/cdn_export/manifest", ignore_errors=True, onerror=None)
-        shutil.rmtree(export_dir)
+    if not stage_done(checkpoint, 'archived'):
+        if not args.notar:
+            # A TAR written in streaming mode has consumed the export tree it was written from
+            if checkpoint.get('streaming') and checkpoint.get('tarname'):
+                msg = "The interrupted export was being archived in streaming mode and cannot " \
+                    "be resumed. Run the export again without --resume."
+                helpers.log_msg(msg, 'ERROR')
+                sys.exit(1)
+
+            # Discard the chunks of any TAR that an interrupted run did not finish writing
+            if checkpoint.get('tarname'):
+                for chunk in glob(helpers.EXPORTDIR + '/sat6_export_' + checkpoint['tarname'] + '[._]*'):
+                    os.remove(chunk)
+            checkpoint['tarname'] = datetime.datetime.strftime(datetime.datetime.now(),
+                '%Y%m%d-%H%M') + '_' + ename
+            write_checkpoint(ename, checkpoint)
+
+            # Files checksummed by the dedup check are not checksummed again
+            checksums = dict(checkpoint['checksums'])
+            (chunks, inventory) = create_tar(export_dir, inventory, ename, checkpoint['tarname'],
+                export_history, args.splitsize, checksums, checkpoint.get('streaming', False))
+            write_manifest(checkpoint['tarname'], ename, export_type, inventory, checksums,
+                chunks, get_repo_paths(repolist, set(exported_repos) | set(package_count.keys())),
+                exported_repos, package_count, checkpoint['skipped'])
+            checkpoint['new_files'] = shipped_files(export_dir, inventory, checksums)
+        else:
+            checkpoint['new_files'] = {}
+            if not args.nodedup:
+                checkpoint['new_files'] = shipped_files(export_dir, inventory,
+                    dict(checkpoint['checksums']))
+
+            # We need to manually clean up a couple of working files from the export
+            if os.path.exists(helpers.EXPORTDIR + "/iso"):
+                shutil.rmtree(helpers.EXPORTDIR + "/iso")
+            if os.path.exists(helpers.EXPORTDIR + "/puppet"):
+                shutil.rmtree(helpers.EXPORTDIR + "/puppet")
+            os.system("rm -f " + helpers.EXPORTDIR + "/*.pkl")
+            os.system("rm -f " + export_dir + "/*.pkl")
+
+            # Copy export_dir to cdn_export to prevent blowing it away next time we export
+            copy_tree(export_dir,helpers.EXPORTDIR + "/cdn_export")
+            # Cleanup
+            shutil.rmtree(helpers.EXPORTDIR + "/cdn_export/manifest", ignore_errors=True, onerror=None)
+            shutil.rmtree(export_dir)
+        set_checkpoint_stage(ename, checkpoint, 'archived')
 
     # We're done. Write the start timestamp to file for next time
     os.chdir(script_dir)
-    pickle.dump(export_times, open(vardir + '/exports_' + ename + '.pkl', "wb"))
+    state.set_export_times(ename, export_times)
+    if checkpoint.get('sizes'):
+        state.set_export_sizes(ename, checkpoint['sizes'])
+    if not args.nodedup:
+        state.add_shipped(ename, checkpoint['new_files'])
+    clear_checkpoint(ename)
 
     # And we're done!
     print helpers.GREEN + "Export complete.\n" + helpers.ENDC
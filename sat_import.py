@@ -8,16 +8,21 @@
 #==============================================================================
 """Import Satellite 6 yum content exported by sat_export.py."""
 
-import sys, argparse, os, pickle
+import sys, argparse, os, pickle, shutil, tarfile
+from hashlib import sha256
 import simplejson as json
 import helpers
 
+# Headroom added to the extracted size of a dataset when checking the available space
+CAPACITY_MARGIN = 1.1
+
 
 def get_inputfiles(dataset):
-    """Verify the input files exist and are valid.
+    """Verify the input files exist.
 
     'dataset' is a date (YYYYMMDD-HHMM_ENV) provided by the user - date is in the filename of the archive
-    Returned 'basename' is the full export filename (sat6_export_YYYYMMDD-HHMM_ENV)
+    Returned 'basename' is the full export filename (sat6_export_YYYYMMDD-HHMM_ENV), along with
+    a list of (sha256sum, chunkname) entries read from the .sha256 file.
     """
     basename = 'sat6_export_' + dataset
     shafile = basename + '.sha256'
@@ -30,88 +35,410 @@ def get_inputfiles(dataset):
             helpers.mailout(helpers.MAILSUBJ_FI, output)
         sys.exit(1)
 
-    # Verify the checksum of each part of the import
-    os.chdir(helpers.IMPORTDIR)
-    msg = 'Verifying Checksums in ' + helpers.IMPORTDIR + '/' + shafile
+    # Read the expected checksum of each part of the import
+    chunks = []
+    for line in open(helpers.IMPORTDIR + '/' + shafile, 'r'):
+        if line.strip():
+            shasum, chunkname = line.split(None, 1)
+            chunks.append((shasum, chunkname.strip().lstrip('*')))
+
+    for shasum, chunkname in chunks:
+        if not os.path.exists(helpers.IMPORTDIR + '/' + chunkname):
+            msg = "Cannot continue - missing import file " + helpers.IMPORTDIR + '/' + chunkname
+            helpers.log_msg(msg, 'ERROR')
+            if helpers.MAILOUT:
+                helpers.tf.seek(0)
+                output = "{}".format(helpers.tf.read())
+                helpers.mailout(helpers.MAILSUBJ_FI, output)
+            sys.exit(1)
+
+    return basename, chunks
+
+
+def read_manifest(basename, chunks):
+    """Read the bundle manifest of the dataset, if the export included one.
+
+    The manifest lists the repos and files in the dataset with their sizes and
+    checksums, so the dataset can be inspected before it is extracted. A manifest
+    that does not describe the same chunks as the .sha256 file is ignored.
+    """
+    manifest_file = helpers.IMPORTDIR + '/' + basename + '.manifest.json'
+    if not os.path.exists(manifest_file):
+        msg = "No bundle manifest found for " + basename
+        helpers.log_msg(msg, 'DEBUG')
+        return None
+
+    manifest = json.load(open(manifest_file, 'r'))
+    if [(chunk['sha256'], chunk['name']) for chunk in manifest['chunks']] != chunks:
+        msg = "Bundle manifest " + manifest_file + " does not match the sha256sum file - ignoring it"
+        helpers.log_msg(msg, 'WARNING')
+        return None
+
+    msg = "Dataset " + manifest['dataset'] + " contains " + str(len(manifest['repos'])) \
+        + " repos, " + str(len(manifest['files'])) + " files (" \
+        + str(manifest['size'] / 1048576) + " MB) in " + str(len(manifest['chunks'])) + " parts"
     helpers.log_msg(msg, 'INFO')
     print msg
-    result = os.system('sha256sum -c ' + shafile)
+    if manifest.get('skipped'):
+        msg = str(len(manifest['skipped'])) + " files were left out of the dataset as they were" \
+            + " shipped in an earlier export"
+        helpers.log_msg(msg, 'INFO')
+    return manifest
+
 
-    # Return code from sha256sum is 0 if all is fine.
-    if result != 0:
-        msg = "Import Aborted - Tarfile checksum verification failed"
+def select_repos(manifest, repos, exclude_repos):
+    """Return the labels of the repos in the dataset that are to be imported.
+
+    'repos' and 'exclude_repos' are comma separated lists of repo labels. Labels
+    that are not in the dataset are reported and ignored.
+    """
+    available = set(manifest['repos'].keys())
+    if repos:
+        requested = set(repos.split(','))
+        selected = available & requested
+    else:
+        requested = set(exclude_repos.split(','))
+        selected = available - requested
+    for label in sorted(requested - available):
+        msg = "Repo " + label + " is not in dataset " + manifest['dataset']
+        helpers.log_msg(msg, 'WARNING')
+
+    msg = "Importing " + str(len(selected)) + " of " + str(len(available)) + " repos in the dataset"
+    helpers.log_msg(msg, 'INFO')
+    print msg
+    return selected
+
+
+def member_filter(manifest, selected):
+    """Return a function that tells whether a tar member is to be extracted.
+
+    Members that belong to a repo that is not selected are skipped. Directories
+    above the repos, the listing files within them and the dataset metadata at the
+    top of the tree are always extracted.
+    """
+    prefixes = sorted([(repo['path'], label) for label, repo in manifest['repos'].iteritems()
+        if repo['path']], reverse=True)
+
+    def wanted(name):
+        path = os.path.normpath(name)
+        for prefix, label in prefixes:
+            if path == prefix or path.startswith(prefix + '/'):
+                return label in selected
+        return True
+    return wanted
+
+
+def check_capacity(manifest, chunks, checkpoint, wanted, unattended):
+    """Check that IMPORTDIR has room to extract the dataset.
+
+    The extracted size is taken from the bundle manifest, counting only the files
+    that will be extracted, or from the size of the archive parts if there is no
+    manifest. Content already extracted by an interrupted run is allowed for.
+    Previous imports are only removed once the extraction has been verified, so
+    they are not counted as free space.
+    """
+    if manifest:
+        required = sum([entry['size'] for entry in manifest['files']
+            if wanted is None or wanted(entry['path'])])
+    else:
+        required = sum([os.path.getsize(helpers.IMPORTDIR + '/' + chunkname)
+            for shasum, chunkname in chunks])
+    required = int(max(required - checkpoint['offset'], 0) * CAPACITY_MARGIN)
+    free = helpers.disk_free(helpers.IMPORTDIR)
+    msg = "Extraction requires " + str(required / 1048576) + " MB, " + str(free / 1048576) \
+        + " MB free in " + helpers.IMPORTDIR
+    helpers.log_msg(msg, 'INFO')
+    if free >= required:
+        return
+
+    msg = "Insufficient space in " + helpers.IMPORTDIR + " to extract the dataset"
+    helpers.log_msg(msg, 'WARNING')
+    if not unattended:
+        answer = helpers.query_yes_no("Continue with import?", "no")
+        if not answer:
+            msg = "Import Aborted"
+            helpers.log_msg(msg, 'ERROR')
+            sys.exit(3)
+        else:
+            msg = "Import continued by user"
+            helpers.log_msg(msg, 'INFO')
+    else:
+        msg = "Import Aborted"
         helpers.log_msg(msg, 'ERROR')
         if helpers.MAILOUT:
             helpers.tf.seek(0)
             output = "{}".format(helpers.tf.read())
             helpers.mailout(helpers.MAILSUBJ_FI, output)
-        sys.exit(1)
+        sys.exit(3)
 
-    # We're good
-    msg = "Tarfile checksum verification passed"
-    helpers.log_msg(msg, 'INFO')
-    print helpers.GREEN + "Checksum verification - Pass" + helpers.ENDC
 
-    return basename
+class ChunkReader(object):
+    """Read a set of split tar chunks as a single stream.
+
+    The sha256sum of each chunk is calculated as the stream is read, so the
+    checksums can be verified without a separate pass over the data.
+
+    Each chunk is verified as soon as its last byte has been read, so that a read
+    ending on a chunk boundary already counts the chunk as verified.
+
+    To resume an interrupted extraction the stream can be started at 'offset'.
+    Chunks listed in 'verified' that end before the offset are skipped entirely.
+    'verified_end' is the stream offset up to which every chunk has passed.
+    """
 
+    def __init__(self, chunks, verified=None, offset=0):
+        self.chunks = list(chunks)
+        self.verified = list(verified or [])
+        self.failed = []
+        self.f_handle = None
+        self.shasum = None
+        self.current = None
+        self.verified_end = 0
+        while self.chunks and self.chunks[0][1] in self.verified:
+            size = os.path.getsize(self.chunks[0][1])
+            if self.verified_end + size > offset:
+                break
+            self.verified_end = self.verified_end + size
+            self.chunks.pop(0)
+        self.skip = offset - self.verified_end
+
+    def __next_chunk(self):
+        if self.f_handle is not None:
+            self.__close_chunk()
+        if not self.chunks:
+            return False
+        self.current = self.chunks.pop(0)
+        self.f_handle = open(self.current[1], 'rb')
+        self.shasum = sha256()
+        self.size = 0
+        self.length = os.path.getsize(self.current[1])
+
+        # The start of a part-extracted chunk is only read to complete its checksum
+        while self.skip:
+            part = self.f_handle.read(min(self.skip, 1048576))
+            if not part:
+                break
+            self.shasum.update(part)
+            self.size = self.size + len(part)
+            self.skip = self.skip - len(part)
+        return True
+
+    def __close_chunk(self):
+        self.f_handle.close()
+        self.f_handle = None
+        if self.shasum.hexdigest() != self.current[0]:
+            self.failed.append(self.current[1])
+            msg = self.current[1] + ": FAILED"
+        else:
+            if not self.failed:
+                self.verified_end = self.verified_end + self.size
+                if self.current[1] not in self.verified:
+                    self.verified.append(self.current[1])
+            msg = self.current[1] + ": OK"
+        helpers.log_msg(msg, 'DEBUG')
 
-def extract_content(basename):
-    """Extract the tar archive."""
+    def read(self, size=-1):
+        """Return up to 'size' bytes from the chunk stream."""
+        data = ''
+        while size < 0 or len(data) < size:
+            if self.f_handle is None and not self.__next_chunk():
+                break
+            if size < 0:
+                part = self.f_handle.read()
+            else:
+                part = self.f_handle.read(size - len(data))
+            if not part:
+                self.__close_chunk()
+                continue
+            self.shasum.update(part)
+            self.size = self.size + len(part)
+            data = data + part
+            if self.size >= self.length:
+                self.__close_chunk()
+        return data
+
+    def close(self):
+        """Drain any remaining chunks so that every checksum is verified."""
+        while self.read(1048576):
+            pass
+
+
+def extract_content(basename, chunks, dataset, checkpoint, wanted=None):
+    """Verify and extract the tar archive.
+
+    The chunks are checksummed as they are streamed into a staging directory. The
+    extracted content only replaces any previous import once every chunk has passed.
+    The verified chunks and the offset of the last tar member extracted from them
+    are recorded in the import checkpoint, so an interrupted extraction resumes there.
+
+    If 'wanted' is given, only the tar members it returns True for are extracted.
+    Every chunk is still read in full to verify its checksum.
+    """
     os.chdir(helpers.IMPORTDIR)
+    staging = helpers.IMPORTDIR + '/.' + basename
+    if checkpoint['stage'] is None:
+        if checkpoint['offset'] == 0 and os.path.exists(staging):
+            shutil.rmtree(staging)
+        if not os.path.exists(staging):
+            checkpoint['offset'] = 0
+            checkpoint['verified'] = []
+            os.makedirs(staging)
+
+        msg = 'Verifying Checksums and extracting tarfiles from ' + helpers.IMPORTDIR + '/' \
+            + basename + '.sha256'
+        if checkpoint['offset']:
+            msg = msg + ' (resuming after ' + str(len(checkpoint['verified'])) + ' verified files)'
+        helpers.log_msg(msg, 'INFO')
+        print msg
+        base = checkpoint['offset']
+        reader = ChunkReader(chunks, checkpoint['verified'], base)
+        extracted = False
+        try:
+            with tarfile.open(fileobj=reader, mode='r|', bufsize=1048576) as archive:
+                for member in archive:
+                    if wanted is None or wanted(member.name):
+                        archive.extract(member, staging)
+
+                    # Checkpoint once per verified chunk, at a member boundary within verified data
+                    if base + archive.offset <= reader.verified_end and \
+                        len(reader.verified) > len(checkpoint['verified']):
+                        checkpoint['offset'] = base + archive.offset
+                        checkpoint['verified'] = list(reader.verified)
+                        write_checkpoint(dataset, checkpoint)
+            extracted = True
+        except tarfile.TarError, e:
+            msg = "Unable to extract tarfiles: " + str(e)
+            helpers.log_msg(msg, 'ERROR')
+        reader.close()
 
-    # Extract the archives (Using OS call for this at the moment)
-    msg = "Extracting tarfiles"
-    helpers.log_msg(msg, 'INFO')
-    print msg
-    os.system('cat ' + basename + '_* | tar xpf -')
+        # Any corrupt chunk aborts the import before the existing content is touched.
+        # The staging directory is kept so that the import can be resumed.
+        if reader.failed or not extracted:
+            for chunkname in reader.failed:
+                msg = chunkname + ": FAILED"
+                helpers.log_msg(msg, 'ERROR')
+            msg = "Import Aborted - Tarfile checksum verification failed"
+            helpers.log_msg(msg, 'ERROR')
+            msg = "Replace the failed files and re-run with --resume to continue the import"
+            helpers.log_msg(msg, 'INFO')
+            if helpers.MAILOUT:
+                helpers.tf.seek(0)
+                output = "{}".format(helpers.tf.read())
+                helpers.mailout(helpers.MAILSUBJ_FI, output)
+            sys.exit(1)
+
+        # We're good
+        msg = "Tarfile checksum verification passed"
+        helpers.log_msg(msg, 'INFO')
+        print helpers.GREEN + "Checksum verification - Pass" + helpers.ENDC
+
+        # Cleanup from any previous imports
+        os.system("rm -rf " + helpers.IMPORTDIR + "/{content,custom,listing,*.pkl}")
+        checkpoint['stage'] = 'unpacked'
+        checkpoint['verified'] = list(reader.verified)
+        write_checkpoint(dataset, checkpoint)
+
+    # Move the new content into place
+    for name in os.listdir(staging):
+        target = os.path.join(helpers.IMPORTDIR, name)
+        if os.path.isdir(target) and not os.path.islink(target):
+            shutil.rmtree(target)
+        elif os.path.lexists(target):
+            os.remove(target)
+        os.rename(os.path.join(staging, name), target)
+    os.rmdir(staging)
+    checkpoint['stage'] = 'extracted'
+    write_checkpoint(dataset, checkpoint)
+
+
+def read_checkpoint(dataset):
+    """Read the checkpoint journal left behind by an interrupted import, if any."""
+    return state.get_checkpoint('import_' + dataset)
 
 
-def sync_content(org_id, imported_repos):
+def write_checkpoint(dataset, checkpoint):
+    """Write the checkpoint journal to the state store."""
+    state.put_checkpoint('import_' + dataset, checkpoint)
+
+
+def clear_checkpoint(dataset):
+    """Remove the checkpoint journal once an import has completed."""
+    state.clear_checkpoint('import_' + dataset)
+
+
+def plan_sync_batches(repo_ids, weights, batchsize, inflight):
+    """Split repo IDs into sync batches balanced by package count.
+
+    Repos are taken largest first and packed into batches of at most 'batchsize'
+    repos, each holding roughly an equal share of the total package count. Every
+    repo also counts as one package, so repos without a count are spread evenly.
+    At least 'inflight' batches are planned so that every sync slot can be used.
+    Returns the batches in the order they should be started.
+    """
+    cost = {}
+    for repo_id in repo_ids:
+        cost[repo_id] = weights.get(repo_id, 0) + 1
+    ordered = sorted(repo_ids, key=lambda repo_id: cost[repo_id], reverse=True)
+    numbatches = max(-(-len(ordered) // batchsize), min(inflight, len(ordered)))
+    budget = -(-sum(cost.values()) // numbatches)
+
+    batches = []
+    batch = []
+    batchcost = 0
+    for repo_id in ordered:
+        if batch and (len(batch) == batchsize or batchcost + cost[repo_id] > budget):
+            batches.append(batch)
+            batch = []
+            batchcost = 0
+        batch.append(repo_id)
+        batchcost = batchcost + cost[repo_id]
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def sync_content(org_id, imported_repos, package_count, dataset, checkpoint):
     """Synchronize the repositories.
 
-    Triggers a sync of all repositories belonging to the configured sync plan
+    Triggers a sync of all repositories belonging to the configured sync plan.
+    Up to SYNCINFLIGHT bulk sync tasks are run at once, with the batches sized by
+    the package counts from the sync host and the largest repos started first.
+    Repos in batches that synced successfully are recorded in the import checkpoint
+    and are not synced again when the import is resumed.
     """
+    weights = {}
     repos_to_sync = []
     delete_override = False
     newrepos = False
+    checkpoint['sync_failed'] = False
 
     # Get a listing of repositories in this Satellite
-    enabled_repos = helpers.get_p_json(
+    enabled_repos = list(helpers.get_paged(
         helpers.KATELLO_API + "/repositories/",
-        json.dumps(
-                {
-                    "organization_id": org_id,
-                    "per_page": '1000',
-                }
-            )
-        )
+        {
+            "organization_id": org_id,
+        }))
+
+    # Index the enabled repos by label so each imported repo is found with a single lookup
+    repo_index = {}
+    for repo_result in enabled_repos:
+        repo_index.setdefault(repo_result['label'], []).append(repo_result)
 
     # Loop through each repo to be imported/synced
+    mirror_updates = []
     for repo in imported_repos:
-        do_import = False
-        for repo_result in enabled_repos['results']:
-            if repo in repo_result['label']:
-                # Ensure we have an exact match on the repo label
-                if repo == repo_result['label']:
-                    do_import = True
-                    repos_to_sync.append(repo_result['id'])
-
-                    # Ensure Mirror-on-sync flag is set to FALSE to make sure incremental
-                    # import does not (cannot) delete existing packages.
-                    msg = "Setting mirror-on-sync=false for repo id " + str(repo_result['id'])
-                    helpers.log_msg(msg, 'DEBUG')
-                    helpers.put_json(
-                        helpers.KATELLO_API + "/repositories/" + str(repo_result['id']),
-                        json.dumps(
-                                {
-                                    "mirror_on_sync": False
-                                }
-                            )
-                        )
-
-        if do_import:
+        if repo in repo_index:
             msg = "Repo " + repo + " found in Satellite"
             helpers.log_msg(msg, 'DEBUG')
+            for repo_result in repo_index[repo]:
+                repos_to_sync.append(repo_result['id'])
+                if repo in package_count:
+                    weights[repo_result['id']] = int(package_count[repo].split(':')[0])
+
+                # Ensure Mirror-on-sync flag is set to FALSE to make sure incremental
+                # import does not (cannot) delete existing packages.
+                if repo_result.get('mirror_on_sync') is not False:
+                    mirror_updates.append(repo_result['id'])
         else:
             msg = "Repo " + repo + " is not enabled in Satellite"
             newrepos = True
@@ -121,6 +448,28 @@ def sync_content(org_id, imported_repos):
             helpers.log_msg(msg, 'WARNING')
             # TODO: We could go on here and try to enable the Red Hat repo .....
 
+    # Only repos that are not already set to mirror_on_sync=false need updating
+    if mirror_updates:
+        msg = "Setting mirror-on-sync=false for repo ids " + str(mirror_updates)
+        helpers.log_msg(msg, 'DEBUG')
+        helpers.run_concurrent(
+            lambda repo_id: helpers.put_json(
+                helpers.KATELLO_API + "/repositories/" + str(repo_id),
+                json.dumps(
+                        {
+                            "mirror_on_sync": False
+                        }
+                    )
+                ), mirror_updates)
+
+    # Skip the repos that an interrupted run of this import has already synced
+    synced = [repo_id for repo_id in repos_to_sync if repo_id in checkpoint['synced']]
+    if synced:
+        msg = "Skipping " + str(len(synced)) + " repos already synced by an earlier run of this import"
+        helpers.log_msg(msg, 'INFO')
+        print msg
+        repos_to_sync = [repo_id for repo_id in repos_to_sync if repo_id not in synced]
+
     # If we get to here and nothing was added to repos_to_sync we will abort the import.
     # This will probably occur on the initial import - nothing will be enabled in Satellite.
     # Also if there are no updates during incremental sync.
@@ -136,12 +485,18 @@ def sync_content(org_id, imported_repos):
         helpers.log_msg(msg, 'INFO')
         print msg
 
-        # Break repos_to_sync into groups of n
-        repochunks = [ repos_to_sync[i:i+helpers.SYNCBATCH] for i in range(0, len(repos_to_sync), helpers.SYNCBATCH) ]
+        # Break repos_to_sync into batches of at most n repos, balanced by package count
+        batches = plan_sync_batches(repos_to_sync, weights, helpers.SYNCBATCH,
+            helpers.SYNCINFLIGHT)
+        msg = "Syncing " + str(len(repos_to_sync)) + " repos in " + str(len(batches)) \
+            + " batches, up to " + str(helpers.SYNCINFLIGHT) + " at a time"
+        helpers.log_msg(msg, 'INFO')
+
+        # Keep up to SYNCINFLIGHT bulk sync tasks running, tracked in a single poll loop
+        result = {'delete_override': delete_override}
 
-        # Loop through the smaller batches of repos and sync them
-        for chunk in repochunks:
-            chunksize = len(chunk)
+        def start(batch):
+            index, chunk = batch
             msg = "Syncing repo batch " + str(chunk)
             helpers.log_msg(msg, 'DEBUG')
             task_id = helpers.post_json(
@@ -152,20 +507,30 @@ def sync_content(org_id, imported_repos):
                         }
                     )
                 )["id"]
-            msg = "Repo sync task id = " + task_id
+            packages = sum([weights.get(repo_id, 0) for repo_id in chunk])
+            msg = "Repo sync task id = " + task_id + " (" + str(len(chunk)) + " repos, " \
+                + str(packages) + " packages)"
             helpers.log_msg(msg, 'DEBUG')
+            return task_id, "Batch " + str(index) + " (" + str(len(chunk)) + " repos, " \
+                + str(packages) + " packages)"
 
-            # Now we need to wait for the sync to complete
-            helpers.wait_for_task(task_id, 'sync')
-
-            tinfo = helpers.get_task_status(task_id)
+        def finish(batch, tinfo):
+            index, chunk = batch
             if tinfo['state'] != 'running' and tinfo['result'] == 'success':
-                msg = "Batch of " + str(chunksize) + " repos complete"
+                msg = "Batch of " + str(len(chunk)) + " repos complete"
                 helpers.log_msg(msg, 'INFO')
                 print helpers.GREEN + msg + helpers.ENDC
+                checkpoint['synced'].extend(chunk)
             else:
                 msg = "Batch sync has errors"
                 helpers.log_msg(msg, 'WARNING')
+                checkpoint['sync_failed'] = True
+                result['delete_override'] = True
+            write_checkpoint(dataset, checkpoint)
+
+        helpers.run_tasks(list(enumerate(batches, 1)), start, finish, helpers.SYNCINFLIGHT,
+            "Sync of repositories", False)
+        delete_override = result['delete_override']
 
         return (delete_override, newrepos)
 
@@ -190,64 +555,79 @@ def check_counts(org_id, package_count, count):
     """
 
     # Get a listing of repositories in this Satellite
-    enabled_repos = helpers.get_p_json(
+    enabled_repos = list(helpers.get_paged(
         helpers.KATELLO_API + "/repositories/",
-        json.dumps(
-                {
-                    "organization_id": org_id,
-                    "per_page": '1000',
-                }
-            )
-        )
+        {
+            "organization_id": org_id,
+        }))
+
+    # Index the enabled repos by label so each imported repo is found with a single lookup
+    repo_index = {}
+    for repo_result in enabled_repos:
+        repo_index.setdefault(repo_result['label'], []).append(repo_result)
+
+    # First loop through the repos in the import dict and find the local repos
+    matches = []
+    for repo, counts in package_count.iteritems():
+        for repo_result in repo_index.get(repo, []):
+            matches.append((repo, counts, repo_result))
+
+    # Use the counts from the listing where present, and fetch the rest concurrently
+    local_counts = {}
+    fetch = []
+    for repo, counts, repo_result in matches:
+        if 'rpm' in (repo_result.get('content_counts') or {}):
+            local_counts[repo_result['id']] = repo_result['content_counts']['rpm']
+        else:
+            fetch.append(repo_result['id'])
+    if fetch:
+        msg = "Fetching package counts of " + str(len(fetch)) + " repositories individually"
+        helpers.log_msg(msg, 'DEBUG')
+        for repo_id, result in zip(fetch, helpers.run_concurrent(count_packages, fetch)):
+            local_counts[repo_id] = result[0]
 
-    # First loop through the repos in the import dict and find the local ID
     table_data = []
     logtable_data = []
     display_data = False
-    for repo, counts in package_count.iteritems():
+    for repo, counts, repo_result in matches:
         # Split the count data into packages and erratum
         sync_pkgs = counts.split(':')[0]
         sync_erratum = counts.split(':')[1]
 
-        # Loop through each repo and count the local pkgs in each repo
-        for repo_result in enabled_repos['results']:
-            if repo in repo_result['label']:
-                # Ensure we have an exact match on the repo label
-                if repo == repo_result['label']:
-                    local_pkgs, local_erratum = count_packages(repo_result['id'])
-
-                    # Set the output colour of the table entry based on the pkg counts
-                    if int(local_pkgs) == int(sync_pkgs):
-                        colour = helpers.GREEN
-                        display = False
-                    elif int(local_pkgs) == 0 and int(sync_pkgs) != 0:
-                        colour = helpers.RED
-                        display = True
-                        display_data = True
-                    elif int(local_pkgs) < int(sync_pkgs):
-                        colour = helpers.YELLOW
-                        display = True
-                        display_data = True
-                    else:
-                        # If local_pkg > sync_pkg - can happen due to 'mirror on sync' option
-                        # - sync host deletes old pkgs. If this is the case we cannot verify
-                        # an exact package status so we'll set BLUE
-                        colour = helpers.BLUE
-                        display = False
-                        display_data = True
-
-                    # Tuncate the repo label to 70 chars and build the table row
-                    reponame = "{:<70}".format(repo)
-                    # Add all counts if it has been requested
-                    if count:
-                        display_data = True
-                        table_data.append([colour, repo[:70], str(sync_pkgs), str(local_pkgs), helpers.ENDC])
-                    else:
-                        # Otherwise only add counts that are non-green (display = True)
-                        if display:
-                            table_data.append([colour, repo[:70], str(sync_pkgs), str(local_pkgs), helpers.ENDC])
-                    # Always log all package data to the log regardless of 'count'
-                    logtable_data.append([repo[:70], str(sync_pkgs), str(local_pkgs)])
+        local_pkgs = local_counts[repo_result['id']]
+
+        # Set the output colour of the table entry based on the pkg counts
+        if int(local_pkgs) == int(sync_pkgs):
+            colour = helpers.GREEN
+            display = False
+        elif int(local_pkgs) == 0 and int(sync_pkgs) != 0:
+            colour = helpers.RED
+            display = True
+            display_data = True
+        elif int(local_pkgs) < int(sync_pkgs):
+            colour = helpers.YELLOW
+            display = True
+            display_data = True
+        else:
+            # If local_pkg > sync_pkg - can happen due to 'mirror on sync' option
+            # - sync host deletes old pkgs. If this is the case we cannot verify
+            # an exact package status so we'll set BLUE
+            colour = helpers.BLUE
+            display = False
+            display_data = True
+
+        # Tuncate the repo label to 70 chars and build the table row
+        reponame = "{:<70}".format(repo)
+        # Add all counts if it has been requested
+        if count:
+            display_data = True
+            table_data.append([colour, repo[:70], str(sync_pkgs), str(local_pkgs), helpers.ENDC])
+        else:
+            # Otherwise only add counts that are non-green (display = True)
+            if display:
+                table_data.append([colour, repo[:70], str(sync_pkgs), str(local_pkgs), helpers.ENDC])
+        # Always log all package data to the log regardless of 'count'
+        logtable_data.append([repo[:70], str(sync_pkgs), str(local_pkgs)])
 
     if display_data:
         msg = '\nRepository package mismatch count verification...'
@@ -272,19 +652,19 @@ def check_counts(org_id, package_count, count):
         print '\n'
 
 
-def check_missing(imports, exports, dataset, fixhistory, vardir):
+def check_missing(imports, exports, dataset, fixhistory):
     """Find any datasets that have not been imported.
 
     Compare export history with import history to identify missed datasets.
 
-    If fixhistory is passed in, saves previous imports in imports.pkl and exits.
+    If fixhistory is passed in, saves previous imports as the import history and exits.
     """
     missing = False
 
     if fixhistory:
         # Remove the last element (this import) before saving - we haven't imported yet!
         exports = exports[:-1]
-        pickle.dump(exports, open(vardir + '/imports.pkl', "wb"))
+        state.set_imports(exports)
 
         # Copy the current 'exporthistory' over the 'importhistory' to 'fix' current mismatches
         msg = "Saved export history as import history. Please re-run this import."
@@ -321,8 +701,10 @@ def main(args):
     # Set the base dir of the script and where the var data is
     global dir
     global vardir
+    global state
     dir = os.path.dirname(__file__)
     vardir = os.path.join(dir, 'var')
+    state = helpers.StateStore(vardir)
 
     # Log the fact we are starting
     msg = "------------- Content import started by " + runuser + " ----------------"
@@ -351,6 +733,13 @@ def main(args):
         required=False, action="store_true")
     parser.add_argument('--fixhistory', help='Force import history to match export history',
         required=False, action="store_true")
+    parser.add_argument('--resume', help='Resume an interrupted or incomplete import of the dataset',
+        required=False, action="store_true")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--repos', help='Comma separated list of repo labels to extract and sync',
+        required=False)
+    group.add_argument('--exclude-repos', help='Comma separated list of repo labels NOT to extract and sync',
+        required=False)
     args = parser.parse_args()
 
     # Set our script variables from the input args
@@ -371,25 +760,17 @@ def main(args):
     # Get the org_id (Validates our connection to the API)
     org_id = helpers.get_org_id(org_name)
 
-    imports = []
-    # Read the last imports data
-    if os.path.exists(vardir + '/imports.pkl'):
-        imports = pickle.load(open(vardir + '/imports.pkl', 'rb'))
-        # If we have a string we convert to a list. This should only occur the first time we
-        # migrate from the original string version of the pickle.
-        if type(imports) is str:
-            imports = imports.split()
-        last_import = imports[-1]
     # Display the last successful import(s)
     if args.last or args.list:
-        if os.path.exists(vardir + '/imports.pkl'):
+        last_import = state.get_last_import()
+        if last_import:
             if args.last:
                 msg = "Last successful import was " + last_import
                 helpers.log_msg(msg, 'INFO')
                 print msg
             if args.list:
                 print "Completed imports:\n----------------"
-                for item in imports: print item
+                for item in state.get_imports(): print item
         else:
             msg = "Import has never been performed"
             helpers.log_msg(msg, 'INFO')
@@ -400,28 +781,69 @@ def main(args):
     if args.dataset is None:
         parser.error("--dataset is required")
 
+    # Pick up the checkpoint journal of an interrupted import if we are resuming
+    checkpoint = None
+    if args.resume:
+        checkpoint = read_checkpoint(dataset)
+        if checkpoint:
+            msg = "Resuming import of " + dataset + " (" + str(len(checkpoint['verified'])) \
+                + " files verified, " + str(len(checkpoint['synced'])) + " repos synced)"
+        else:
+            msg = "No interrupted import found for " + dataset + ", starting a new import"
+        helpers.log_msg(msg, 'INFO')
+        print msg
+    if not checkpoint:
+        checkpoint = {'stage': None, 'verified': [], 'offset': 0, 'synced': [],
+            'sync_failed': False, 'repos': None}
+
     # If we have already imported this dataset let the user know
-    if dataset in imports:
+    if state.is_imported(dataset) and not checkpoint['stage']:
         if not args.force:
             msg = "Dataset " + dataset + " has already been imported. Use --force if you really want to do this."
             helpers.log_msg(msg, 'WARNING')
             sys.exit(2)
 
     # Figure out if we have the specified input fileset
-    basename = get_inputfiles(dataset)
-
-    # Cleanup from any previous imports
-    os.system("rm -rf " + helpers.IMPORTDIR + "/{content,custom,listing,*.pkl}")
+    (basename, chunks) = get_inputfiles(dataset)
+    manifest = read_manifest(basename, chunks)
+
+    # Work out which repos to extract and sync if only some of them were requested.
+    # A resumed import keeps the selection it was started with.
+    wanted = None
+    if checkpoint.get('repos') is not None or args.repos or args.exclude_repos:
+        if not manifest:
+            msg = "Cannot select repos to import - dataset " + dataset + " has no bundle manifest"
+            helpers.log_msg(msg, 'ERROR')
+            if helpers.MAILOUT:
+                helpers.tf.seek(0)
+                output = "{}".format(helpers.tf.read())
+                helpers.mailout(helpers.MAILSUBJ_FI, output)
+            sys.exit(1)
+        if checkpoint.get('repos') is None:
+            checkpoint['repos'] = sorted(select_repos(manifest, args.repos, args.exclude_repos))
+        else:
+            msg = "Resuming import of selected repos: " + ", ".join(checkpoint['repos'])
+            helpers.log_msg(msg, 'INFO')
+        wanted = member_filter(manifest, set(checkpoint['repos']))
 
-    # Extract the input files
-    extract_content(basename)
+    # Verify and extract the input files
+    if checkpoint['stage'] == 'extracted':
+        msg = "Dataset " + dataset + " has already been extracted"
+        helpers.log_msg(msg, 'INFO')
+        print msg
+        os.chdir(helpers.IMPORTDIR)
+    else:
+        if checkpoint['stage'] is None:
+            check_capacity(manifest, chunks, checkpoint, wanted, args.unattended)
+        write_checkpoint(dataset, checkpoint)
+        extract_content(basename, chunks, dataset, checkpoint, wanted)
 
     # Read in the export history from the input dataset
     dsname = dataset.split('_')[1]
     exports = pickle.load(open(helpers.IMPORTDIR + '/exporthistory_' + dsname + '.pkl', 'rb'))
 
     # Check for and let the user decide if they want to continue with missing imports
-    missing_imports = check_missing(imports, exports, dataset, fixhistory, vardir)
+    missing_imports = check_missing(state.get_imports(), exports, dataset, fixhistory)
     if missing_imports:
         msg = "Run sat_import with the --fixhistory flag to reset the import history to this export"
         helpers.log_msg(msg, 'INFO')
@@ -456,8 +878,15 @@ def main(args):
         imported_repos = pickle.load(open('exported_repos.pkl', 'rb'))
         package_count = pickle.load(open('package_count.pkl', 'rb'))
 
+        # Only sync and check the repos that were selected for import
+        if checkpoint.get('repos') is not None:
+            imported_repos = [repo for repo in imported_repos if repo in checkpoint['repos']]
+            package_count = dict([(repo, counts) for repo, counts in package_count.iteritems()
+                if repo in checkpoint['repos']])
+
         # Run a repo sync on each imported repo
-        (delete_override, newrepos) = sync_content(org_id, imported_repos)
+        (delete_override, newrepos) = sync_content(org_id, imported_repos, package_count,
+            dataset, checkpoint)
 
         print helpers.GREEN + "Import complete.\n" + helpers.ENDC
         print 'Please publish content views to make new content available.'
@@ -480,6 +909,10 @@ def main(args):
         msg = "* Not removing input files due to incomplete sync *"
         helpers.log_msg(msg, 'INFO')
         print msg
+        if checkpoint['sync_failed']:
+            msg = "Re-run with --resume to retry only the failed sync batches"
+            helpers.log_msg(msg, 'INFO')
+            print msg
         excode = 2
     else:
         msg = " (Removal of input files was not requested)"
@@ -490,12 +923,14 @@ def main(args):
     msg = "Import Complete"
     helpers.log_msg(msg, 'INFO')
 
-    # Save the last completed import data (append to existing pickle)
+    # Save the last completed import data (append to the import history)
     os.chdir(script_dir)
-    if not os.path.exists(vardir):
-        os.makedirs(vardir)
-    imports.append(dataset)
-    pickle.dump(imports, open(vardir + '/imports.pkl', "wb"))
+    if not (args.resume and state.is_imported(dataset)):
+        state.add_import(dataset)
+
+    # Keep the checkpoint while the input files are kept, so the import can be resumed
+    if not delete_override:
+        clear_checkpoint(dataset)
 
     # Run the mailout
     if helpers.MAILOUT:
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+"""Tests for the resumable, checksummed extraction in sat_import.py."""
+
+import os, sys, types, shutil, tarfile, tempfile, unittest
+from hashlib import sha256
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# helpers reads the site config when it is imported, so sat_import is given a
+# stand-in with just the settings that the extraction uses
+helpers = types.ModuleType('helpers')
+helpers.IMPORTDIR = None
+helpers.MAILOUT = False
+helpers.GREEN = ''
+helpers.ENDC = ''
+helpers.log_msg = lambda msg, level: None
+sys.modules['helpers'] = helpers
+
+import sat_import
+
+
+class FakeState(object):
+    """Keep the import checkpoint journal in memory."""
+
+    def __init__(self):
+        self.checkpoints = {}
+
+    def put_checkpoint(self, name, checkpoint):
+        self.checkpoints[name] = dict(checkpoint, verified=list(checkpoint['verified']))
+
+
+class ExtractContentTest(unittest.TestCase):
+
+    dataset = '20190101-0000_TEST'
+    basename = 'sat6_export_' + dataset
+    chunksize = 1048576
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.importdir = tempfile.mkdtemp()
+        helpers.IMPORTDIR = self.importdir
+        sat_import.state = FakeState()
+
+        # A TAR of files that do not line up with the 1 MB chunk boundaries
+        srcdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, srcdir)
+        os.makedirs(os.path.join(srcdir, 'content'))
+        self.names = []
+        for index in range(12):
+            name = 'content/file%02d.rpm' % index
+            with open(os.path.join(srcdir, name), 'wb') as f_handle:
+                f_handle.write(os.urandom(300000 + index * 1000))
+            self.names.append(name)
+        tarname = os.path.join(srcdir, 'export.tar')
+        with tarfile.open(tarname, 'w') as archive:
+            for name in self.names:
+                archive.add(os.path.join(srcdir, name), name)
+
+        # Split it into whole MB chunks, as sat_export does
+        self.chunks = []
+        with open(tarname, 'rb') as f_handle:
+            while True:
+                data = f_handle.read(self.chunksize)
+                if not data:
+                    break
+                chunkname = self.basename + '_%02d' % len(self.chunks)
+                with open(os.path.join(self.importdir, chunkname), 'wb') as chunk:
+                    chunk.write(data)
+                self.chunks.append((sha256(data).hexdigest(), chunkname))
+        self.assertTrue(len(self.chunks) >= 4)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.importdir)
+
+    def corrupt(self, chunkname):
+        """Flip the last byte of a chunk, returning its original content."""
+        path = os.path.join(self.importdir, chunkname)
+        with open(path, 'rb') as f_handle:
+            data = f_handle.read()
+        with open(path, 'wb') as f_handle:
+            f_handle.write(data[:-1] + chr(ord(data[-1]) ^ 0xff))
+        return data
+
+    def test_corrupt_last_chunk_checkpoints_verified_chunks(self):
+        checkpoint = {'stage': None, 'verified': [], 'offset': 0}
+        original = self.corrupt(self.chunks[-1][1])
+        first = []
+        wanted = lambda name: first.append(name) or True
+        self.assertRaises(SystemExit, sat_import.extract_content, self.basename,
+            self.chunks, self.dataset, checkpoint, wanted)
+
+        journal = sat_import.state.checkpoints['import_' + self.dataset]
+        self.assertTrue(journal['offset'] > 0)
+        self.assertEqual(journal['verified'], [chunk[1] for chunk in self.chunks[:-1]])
+        self.assertTrue(journal['offset'] <= self.chunksize * (len(self.chunks) - 1))
+
+        # Replace the corrupt chunk and resume - content before the offset is not extracted again
+        with open(os.path.join(self.importdir, self.chunks[-1][1]), 'wb') as f_handle:
+            f_handle.write(original)
+        resumed = []
+        wanted = lambda name: resumed.append(name) or True
+        sat_import.extract_content(self.basename, self.chunks, self.dataset, dict(journal), wanted)
+
+        done = [name for name in first if name not in resumed]
+        self.assertTrue(done)
+        self.assertEqual(done + resumed, self.names)
+        for name in self.names:
+            self.assertTrue(os.path.exists(os.path.join(self.importdir, name)))
+        self.assertEqual(sat_import.state.checkpoints['import_' + self.dataset]['stage'],
+            'extracted')
+
+
+if __name__ == '__main__':
+    unittest.main()